@@ -1,13 +1,34 @@
-from dotenv import load_dotenv
+from functools import lru_cache
 import os
-import openai
 
-# Load environment variables from .env file
-load_dotenv()
-OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-OPENAI_ORG_KEY = os.getenv('OPENAI_ORG_KEY')
-PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
+"""Importing the package has no side effect: the .env file is read and the OpenAI client is configured on first use."""
 
-#register to openai API
-openai.api_key = OPENAI_API_KEY
-openai.organization = OPENAI_ORG_KEY
\ No newline at end of file
+# environment variables read from the .env file on first access, as attributes of the package
+ENV_KEYS = ['OPENAI_API_KEY', 'OPENAI_ORG_KEY', 'PINECONE_API_KEY']
+
+
+@lru_cache(maxsize=None)
+def load_env() -> bool:
+    """Load environment variables from the .env file, once."""
+    from dotenv import load_dotenv
+    return load_dotenv()
+
+
+@lru_cache(maxsize=None)
+def configure_openai():
+    """Register the keys of the .env file to the OpenAI API, once.
+    Returns:
+        The configured openai module.
+    """
+    import openai
+    load_env()
+    openai.api_key = os.getenv('OPENAI_API_KEY')
+    openai.organization = os.getenv('OPENAI_ORG_KEY')
+    return openai
+
+
+def __getattr__(name: str):
+    if name in ENV_KEYS:
+        load_env()
+        return os.getenv(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,29 +1,311 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Union, Optional, Iterator, Iterable, Callable, Tuple, BinaryIO
+from contextlib import contextmanager
+from pathlib import Path
+from hashlib import sha256
+from threading import Lock, get_ident
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import os
+import time
 
 from tenacity import retry, stop_after_attempt, wait_fixed
 import requests
+from requests.adapters import HTTPAdapter
 
+from .config import config
 
 """A module to use the Early Evidence Base API."""
 
 
+class HTTPCache:
+    """A persistent on-disk cache of GET responses, keyed by the hash of the url.
+
+    Each entry is a body file and a json file with the url, ETag, Last-Modified and fetch time.
+    Entries younger than ttl are served without touching the network; older entries are revalidated
+    with a conditional request and served from disk on 304 Not Modified. When the cache grows beyond
+    max_size, the least recently used entries are evicted.
+
+    Attributes:
+        directory: The directory of the cache; None disables caching.
+        ttl: Age in seconds after which an entry is revalidated.
+        max_size: Maximum total size in bytes of the cached bodies.
+    """
+    def __init__(self, directory: Optional[str] = config.http_cache_dir, ttl: int = config.http_cache_ttl, max_size: int = config.http_cache_max_size):
+        self.directory = Path(directory) if directory else None
+        self.ttl = ttl
+        self.max_size = max_size
+        self._size: Optional[int] = None
+        self._lock = Lock()
+
+    def get(self, session: requests.Session, url: str, headers: Optional[Dict[str, str]] = None) -> str:
+        """Send a GET request, or serve it from the cache.
+        Args:
+            session: The session to send the request with.
+            url: The url to get.
+            headers: Additional request headers.
+        Returns:
+            The text of the response body.
+        """
+        if self.directory is None:
+            response = session.get(url, headers=headers)
+            response.raise_for_status()
+            return response.text
+        return self._fetch(session, url, headers).read_text(encoding='utf-8')
+
+    @contextmanager
+    def stream(self, session: requests.Session, url: str, headers: Optional[Dict[str, str]] = None) -> Iterator[BinaryIO]:
+        """Send a GET request, or serve it from the cache, as a binary stream that is never loaded in memory at once.
+        Args:
+            session: The session to send the request with.
+            url: The url to get.
+            headers: Additional request headers.
+        Yields:
+            A binary file-like object with the response body.
+        """
+        if self.directory is None:
+            with session.get(url, headers=headers, stream=True) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                yield response.raw
+        else:
+            with open(self._fetch(session, url, headers), 'rb') as f:
+                yield f
+
+    def expire(self, url: str):
+        """Mark the entry of a url as stale, so that the next request revalidates it with the server.
+        Args:
+            url: The url of the entry.
+        """
+        if self.directory is None:
+            return
+        _, meta_file = self._paths(url)
+        meta = self._read_meta(meta_file)
+        if meta is not None:
+            meta['fetched_at'] = 0
+            self._write(meta_file, json.dumps(meta).encode('utf-8'))
+
+    def discard(self, url: str):
+        """Remove the entry of a url, so that the next request fetches it again.
+        Args:
+            url: The url of the entry.
+        """
+        if self.directory is None:
+            return
+        body_file, meta_file = self._paths(url)
+        with self._lock:
+            try:
+                size = body_file.stat().st_size
+                body_file.unlink()
+            except FileNotFoundError:
+                size = 0
+            meta_file.unlink(missing_ok=True)
+            if self._size is not None:
+                self._size -= size
+
+    def _fetch(self, session: requests.Session, url: str, headers: Optional[Dict[str, str]] = None) -> Path:
+        """Make sure a fresh response body is in the cache and return its path."""
+        headers = dict(headers or {})
+        body_file, meta_file = self._paths(url)
+        meta = self._read_meta(meta_file) if body_file.exists() else None
+        if meta is not None:
+            if time.time() - meta['fetched_at'] < self.ttl:
+                os.utime(body_file)  # mark as recently used
+                return body_file
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        with session.get(url, headers=headers, stream=True) as response:
+            if meta is not None and response.status_code == 304:
+                meta['fetched_at'] = time.time()
+                self._write(meta_file, json.dumps(meta).encode('utf-8'))
+                os.utime(body_file)
+                return body_file
+            # only successful responses are stored: an error, even a transient one, is never served from disk
+            response.raise_for_status()
+            if response.status_code != 200:
+                raise requests.HTTPError(f'{response.status_code} response is not cached for url: {url}', response=response)
+            self._store(url, response)
+        return body_file
+
+    def _paths(self, url: str):
+        key = sha256(url.encode('utf-8')).hexdigest()
+        subdir = self.directory / key[:2]
+        return subdir / f'{key}.body', subdir / f'{key}.json'
+
+    @staticmethod
+    def _read_meta(meta_file: Path) -> Optional[Dict[str, Any]]:
+        try:
+            with open(meta_file, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _write(path: Path, content: Union[bytes, Iterator[bytes]]):
+        # write to a temporary file first so that concurrent readers never see a partial entry
+        tmp = path.with_name(f'{path.name}.{os.getpid()}-{get_ident()}.tmp')
+        with open(tmp, 'wb') as f:
+            if isinstance(content, bytes):
+                f.write(content)
+            else:
+                for chunk in content:
+                    f.write(chunk)
+        os.replace(tmp, path)
+
+    def _store(self, url: str, response: requests.Response):
+        body_file, meta_file = self._paths(url)
+        body_file.parent.mkdir(parents=True, exist_ok=True)
+        previous_size = body_file.stat().st_size if body_file.exists() else 0
+        self._write(body_file, response.iter_content(chunk_size=64 * 1024))
+        meta = {
+            "url": url,
+            "etag": response.headers.get('ETag', ''),
+            "last_modified": response.headers.get('Last-Modified', ''),
+            "fetched_at": time.time(),
+        }
+        self._write(meta_file, json.dumps(meta).encode('utf-8'))
+        with self._lock:
+            if self._size is None:
+                self._size = sum(f.stat().st_size for f in self.directory.glob('*/*.body'))
+            else:
+                self._size += body_file.stat().st_size - previous_size
+            if self._size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        # least recently used first, down to 90% of max_size to avoid evicting on every store
+        entries = sorted(((f.stat().st_mtime, f.stat().st_size, f) for f in self.directory.glob('*/*.body')), key=lambda e: e[0])
+        size = sum(e[1] for e in entries)
+        for _, file_size, body_file in entries:
+            if size <= 0.9 * self.max_size:
+                break
+            body_file.unlink(missing_ok=True)
+            body_file.with_suffix('.json').unlink(missing_ok=True)
+            size -= file_size
+        self._size = size
+
+
+HTTP_CACHE = HTTPCache()
+
+
+class RateLimiter:
+    """A thread-safe limiter of the number of requests and tokens sent over a sliding window of one minute.
+
+    Attributes:
+        rpm: Maximum number of requests per minute.
+        tpm: Maximum number of tokens per minute.
+    """
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._sent = deque()  # (time, tokens) of the requests of the last minute
+        self._tokens = 0
+        self._lock = Lock()
+
+    def acquire(self, tokens: int = 0):
+        """Block until a request of a given number of tokens can be sent within the quotas, and account for it.
+        Args:
+            tokens: The number of tokens of the request.
+        """
+        tokens = min(tokens, self.tpm)  # a request larger than the quota would otherwise wait forever
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._sent and now - self._sent[0][0] >= 60:
+                    self._tokens -= self._sent.popleft()[1]
+                if len(self._sent) < self.rpm and self._tokens + tokens <= self.tpm:
+                    self._sent.append((now, tokens))
+                    self._tokens += tokens
+                    return
+                wait = 60 - (now - self._sent[0][0])
+            time.sleep(max(wait, 0.01))
+
+
+def pooled_session(pool_size: int) -> requests.Session:
+    """A keep-alive session that keeps up to pool_size connections open per host, one for each thread sending requests."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def map_concurrently(fn: Callable[[Any], Any], items: Iterable[Any], max_workers: int) -> Iterator[Tuple[Any, Union[Any, Exception]]]:
+    """Call a function on items with a pool of threads.
+    Args:
+        fn: The function to call on each item.
+        items: The items.
+        max_workers: The number of calls running at once.
+    Yields:
+        Each item with the result of fn, or the exception it raised, as soon as it is done.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fn, item): item for item in items}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                result = e
+            yield futures[future], result
+
+
 class API:
     """An abstract class to represent an API."""
+
+    # one pooled keep-alive session per process, shared by all API instances, with a connection for each worker of get_many()
+    session = pooled_session(config.api_max_workers)
+    cache = HTTP_CACHE
+
     def __init__(self) -> None:
         self.base_url = ""
 
     @retry(stop=stop_after_attempt(3), wait=wait_fixed(1))
-    def _get(self, endpoint: str) -> dict:
+    def _get(self, endpoint: str, revalidate: bool = False, session: Optional[requests.Session] = None) -> dict:
         """Send a GET request to the API.
         Args:
             endpoint: The API endpoint to send the request to.
+            revalidate: Whether to revalidate a cached response with the server even if it is still fresh.
+            session: The session to send the request with; the shared session by default.
         Returns:
             The response from the API.
         """
         url = self.base_url + endpoint
-        response = requests.get(url)
-        response.raise_for_status()
-        return response.json()
+        if revalidate:
+            self.cache.expire(url)
+        text = self.cache.get(session or self.session, url)
+        try:
+            return json.loads(text)
+        except ValueError:
+            self.cache.discard(url)
+            raise
+
+    def _parse(self, endpoint: str, parse: Callable[[str, Any], Any], doi: str, response: Any) -> Any:
+        """Parse the response of an endpoint for a DOI. A response without the expected content is removed from the
+        cache, so that the next request fetches it again instead of serving it until it expires."""
+        try:
+            return parse(doi, response)
+        except Exception:
+            self.cache.discard(self.base_url + endpoint)
+            raise
+
+    def _get_many(self, get_one: Callable[[str, requests.Session], Any], dois: List[str], max_workers: int) -> List[Union[Any, Exception]]:
+        """Call get_one on each DOI with a pool of workers sharing a session with a keep-alive connection for each of them.
+        Args:
+            get_one: The method to get the response of one DOI, given the DOI and the session to use.
+            dois: The DOIs.
+            max_workers: The number of requests in flight at once.
+        Returns:
+            The response of each DOI, or the exception raised once the retries are exhausted, in the order of the DOIs.
+        """
+        session = self.session if max_workers <= config.api_max_workers else pooled_session(max_workers)
+        try:
+            results = dict(map_concurrently(lambda doi: get_one(doi, session), dois, max_workers))
+        finally:
+            if session is not self.session:
+                session.close()
+        return [results[doi] for doi in dois]
 
 
 class EEB(API):
@@ -32,15 +314,43 @@ class EEB(API):
         self.base_url = 'https://eeb.embo.org/api/v1'
 
 
-    def get_referee_reports(self, doi: str) -> Dict[str, Any]:
+    def get_referee_reports(self, doi: str, revalidate: bool = False, session: Optional[requests.Session] = None) -> Dict[str, Any]:
         """Get the referee reports for an article from the Early Evidence Base API.
         Args:
             doi: The DOI of the article to get the referee reports for.
+            revalidate: Whether to revalidate a cached response with the server.
+            session: The session to send the request with; the shared session by default.
         Returns:
             The referee reports.
         """
         endpoint = f'/doi/{doi}'
-        response = self._get(endpoint)
+        response = self._get(endpoint, revalidate, session)
+        return self._parse(endpoint, self._referee_reports, doi, response)
+
+    def get_many(self, dois: List[str], max_workers: int = config.api_max_workers, revalidate: bool = False) -> List[Union[Dict[str, Any], Exception]]:
+        """Get the referee reports of many articles concurrently, through the response cache as get_referee_reports().
+        Args:
+            dois: The DOIs of the articles.
+            max_workers: The number of requests in flight at once.
+            revalidate: Whether to revalidate the cached responses with the server.
+        Returns:
+            The referee reports, or the exception raised, for each DOI.
+        """
+        return self._get_many(lambda doi, session: self.get_referee_reports(doi, revalidate, session), dois, max_workers)
+
+    def get_refereed_preprints(self, page: int, per_page: int = 100) -> List[Dict[str, Any]]:
+        """Get one page of the feed of refereed preprints, always revalidated with the server.
+        Args:
+            page: The page number, starting at 1.
+            per_page: The number of refereed preprints per page.
+        Returns:
+            The refereed preprints of the page, each with its review process; empty past the last page.
+        """
+        endpoint = f'/refereed_preprints?page={page}&per_page={per_page}'
+        return self._get(endpoint, revalidate=True)
+
+    @staticmethod
+    def _referee_reports(doi: str, response: List[Dict[str, Any]]) -> Dict[str, Any]:
         if not response:
             raise ValueError(f'No referee reports found for {doi}')
         return response[0]
@@ -52,15 +362,32 @@ class BioRxiv(API):
     def __init__(self) -> None:
          self.base_url = 'https://api.biorxiv.org'
     
-    def get_preprint(self, doi: str) -> Dict[str, Any]:
+    def get_preprint(self, doi: str, revalidate: bool = False, session: Optional[requests.Session] = None) -> Dict[str, Any]:
         """Get the preprint full text from the BioRxiv API.
         Args:
             doi: The DOI of the article to get.
+            revalidate: Whether to revalidate a cached response with the server.
+            session: The session to send the request with; the shared session by default.
         Returns:
             The article.
         """
         endpoint = f'/details/biorxiv/{doi}'
-        response = self._get(endpoint)
+        response = self._get(endpoint, revalidate, session)
+        return self._parse(endpoint, self._preprint, doi, response)
+
+    def get_many(self, dois: List[str], max_workers: int = config.api_max_workers, revalidate: bool = False) -> List[Union[Dict[str, Any], Exception]]:
+        """Get the bioRxiv metadata of many preprints concurrently, through the response cache as get_preprint().
+        Args:
+            dois: The DOIs of the preprints.
+            max_workers: The number of requests in flight at once.
+            revalidate: Whether to revalidate the cached responses with the server.
+        Returns:
+            The preprint metadata, or the exception raised, for each DOI.
+        """
+        return self._get_many(lambda doi, session: self.get_preprint(doi, revalidate, session), dois, max_workers)
+
+    @staticmethod
+    def _preprint(doi: str, response: Dict[str, Any]) -> Dict[str, Any]:
         try:
             preprint = response['collection'][0]
         except Exception as e:
@@ -0,0 +1,155 @@
+from typing import List, Tuple, Callable, Optional, Any
+from functools import partial
+from pathlib import Path
+from hashlib import sha256
+from threading import Lock
+import types
+import json
+import re
+import numpy as np
+
+from .utils import chunk_texts, BOILERPLATE, CHUNKING_VERSION
+from .sqlite_file import SQLiteFile
+from .config import config
+
+
+"""A persistent index of the chunks of the texts of a corpus, as offsets into the texts, so that each text is chunked once."""
+
+
+def chunking_id(chunking_fn: Callable) -> Optional[str]:
+    """Identifies a chunking function together with its parameters, the version of the chunking code and the settings it depends on.
+    The parameters are the arguments of a functools.partial, and the default arguments and the values captured by
+    the closure of a function; a chunking function can also give its own identifier as a cache_id attribute.
+    Returns:
+        The identifier, or None if a parameter has no stable description, in which case the chunks are not indexed.
+    """
+    try:
+        described = _describe(chunking_fn, set())
+    except ValueError:
+        return None
+    settings = json.dumps([described, config.min_length, BOILERPLATE + config.extra_boilerplate, config.sentence_splitter["components"]])
+    digest = sha256(settings.encode('utf-8')).hexdigest()[:16]
+    fn = chunking_fn.func if isinstance(chunking_fn, partial) else chunking_fn
+    name = f"{getattr(fn, '__module__', '')}.{getattr(fn, '__qualname__', type(fn).__qualname__)}"
+    return f"{name}:v{CHUNKING_VERSION}:{digest}"
+
+
+def _describe(value: Any, seen: set) -> Any:
+    """A json description of a chunking function or of one of its parameters; raises ValueError if there is none."""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if getattr(value, 'cache_id', None) is not None:
+        return {"cache_id": str(value.cache_id)}
+    if id(value) in seen:  # a recursive function captured by its own closure
+        return {"recursive": getattr(value, '__qualname__', '')}
+    seen = seen | {id(value)}
+    if isinstance(value, (list, tuple)):
+        return [_describe(v, seen) for v in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted((_describe(v, seen) for v in value), key=json.dumps)
+    if isinstance(value, dict):
+        return sorted(([_describe(k, seen), _describe(v, seen)] for k, v in value.items()), key=json.dumps)
+    if isinstance(value, re.Pattern):
+        return {"pattern": value.pattern if isinstance(value.pattern, str) else value.pattern.hex(), "flags": value.flags}
+    if isinstance(value, partial):
+        return {"partial": _describe(value.func, seen), "args": _describe(value.args, seen), "keywords": _describe(value.keywords, seen)}
+    if isinstance(value, types.FunctionType):
+        try:
+            closure = [cell.cell_contents for cell in value.__closure__ or ()]
+        except ValueError:  # a cell that is not filled yet
+            raise ValueError(f"{value.__qualname__} has an empty closure cell")
+        return {
+            "function": f"{value.__module__}.{value.__qualname__}",
+            "defaults": _describe(value.__defaults__ or (), seen),
+            "kwdefaults": _describe(value.__kwdefaults__ or {}, seen),
+            "closure": _describe(closure, seen),
+        }
+    if isinstance(value, (types.BuiltinFunctionType, type)):
+        return {"function": f"{value.__module__}.{value.__qualname__}"}
+    raise ValueError(f"no stable description of {type(value).__qualname__}; give the chunking function a cache_id")
+
+
+def locate(text: str, chunks: List[str]) -> Optional[np.ndarray]:
+    """Find the chunks, in order, in the text they come from.
+    Returns:
+        The start and end offsets of each chunk, num_chunks x 2, or None if a chunk is not a substring of the text.
+    """
+    offsets = np.empty((len(chunks), 2), dtype=np.int64)
+    cursor = 0
+    for i, chunk in enumerate(chunks):
+        start = text.find(chunk, cursor)
+        if start < 0:
+            return None
+        offsets[i] = start, start + len(chunk)
+        cursor = start + len(chunk)
+    return offsets
+
+
+class ChunkIndex:
+    """A persistent index of chunk boundaries in a SQLite file, per DOI, part of the text and chunking function.
+
+    Texts are chunked once: afterwards their chunks are sliced from the text with the stored offsets. The digest of
+    the text is stored with its offsets, so that entries of texts that changed since, for example after a sync,
+    are chunked again. Chunks that are not substrings of their text are stored as they are. Texts without a DOI,
+    and chunking functions without a stable identifier (see chunking_id()), are chunked every time instead.
+
+    Attributes:
+        path: The path to the SQLite file; None disables the index.
+    """
+    def __init__(self, path: Optional[str] = config.chunk_index_path):
+        self.path = Path(path) if path else None
+        self._file = SQLiteFile(self.path, 'CREATE TABLE IF NOT EXISTS chunks (doi TEXT, part TEXT, chunking TEXT, digest TEXT, offsets BLOB, chunks TEXT, PRIMARY KEY (doi, part, chunking))') if self.path else None
+        self._lock = Lock()
+
+    @staticmethod
+    def digest(text: str) -> str:
+        return sha256(text.encode('utf-8')).hexdigest()
+
+    def get_chunks(self, chunking_fn: Callable, keys: List[Tuple[str, str]], texts: List[str]) -> List[List[str]]:
+        """Chunk texts, chunking only those not yet in the index, all at once.
+        Args:
+            chunking_fn: The function to chunk a text.
+            keys: The DOI and the part of the text (a section or a review) of each text.
+            texts: The texts.
+        Returns:
+            The list of chunks of each text, as chunking_fn would return it.
+        """
+        chunking = chunking_id(chunking_fn) if self.path is not None and texts else None
+        if chunking is None:
+            return chunk_texts(chunking_fn, texts)
+        digests = [self.digest(text) for text in texts]
+        results: List[Optional[List[str]]] = [None] * len(texts)
+        # texts without a DOI are chunked every time: the index has no key for them
+        indexed = [i for i, (doi, _) in enumerate(keys) if doi is not None]
+        if indexed:
+            with self._lock, self._file.transaction() as conn:
+                for i in indexed:
+                    row = conn.execute('SELECT digest, offsets, chunks FROM chunks WHERE doi = ? AND part = ? AND chunking = ?', (*keys[i], chunking)).fetchone()
+                    if row is not None and row[0] == digests[i]:
+                        results[i] = self._chunks(texts[i], row[1], row[2])
+        misses = [i for i, chunks in enumerate(results) if chunks is None]
+        if misses:
+            computed = chunk_texts(chunking_fn, [texts[i] for i in misses])
+            rows = []
+            for i, chunks in zip(misses, computed):
+                results[i] = chunks
+                if keys[i][0] is None:
+                    continue
+                offsets = locate(texts[i], chunks)
+                if offsets is None:
+                    rows.append((*keys[i], chunking, digests[i], None, json.dumps(chunks)))
+                else:
+                    rows.append((*keys[i], chunking, digests[i], offsets.tobytes(), None))
+            if rows:
+                with self._lock, self._file.transaction() as conn:
+                    conn.executemany('INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?, ?)', rows)
+        return results
+
+    @staticmethod
+    def _chunks(text: str, offsets: Optional[bytes], chunks: Optional[str]) -> List[str]:
+        if offsets is None:
+            return json.loads(chunks)
+        return [text[start:end] for start, end in np.frombuffer(offsets, dtype=np.int64).reshape(-1, 2).tolist()]
+
+
+CHUNK_INDEX = ChunkIndex()
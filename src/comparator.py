@@ -1,5 +1,6 @@
 import torch
-from typing import List, Tuple
+from torch.nn.utils.rnn import pad_sequence
+from typing import List, Dict, Tuple, Optional
 
 from src.embed import Embedder
 
@@ -58,3 +59,153 @@ class Comparator:
         A, B = self.get_embeddings(para_1, para_2)
         similarity = torch.mm(A, B.T) / (torch.linalg.norm(A) * torch.linalg.norm(B))
         return similarity
+
+    def compare_topk(
+            self,
+            para_1: List[str],
+            para_2: List[str],
+            k: Optional[int] = None,
+            threshold: Optional[float] = None
+        ) -> torch.Tensor:
+        """Compare two lists of paragraphs as compare_dot(), keeping only the strongest similarities of each paragraph
+        of the first list, computed by topk_dot(). At least one of k and threshold must be given.
+        Args:
+            para_1: The first list of paragraphs, for example the paragraphs of the reviews.
+            para_2: The second list of paragraphs, for example the paragraphs of the preprints.
+            k: The number of similarities kept for each paragraph of the first list; None to keep all those above threshold.
+            threshold: The minimum similarity kept; None to keep the k highest whatever their value.
+
+        Returns:
+            A sparse COO similarity matrix, len(para_1) x len(para_2).
+        """
+        if k is None and threshold is None:
+            raise ValueError("compare_topk() needs k, threshold or both; use compare_dot() for the dense matrix.")
+        A, B = self.get_embeddings(para_1, para_2)
+        return self.topk_dot(A, B, k, threshold)
+
+    @staticmethod
+    def topk_dot(
+            A: torch.Tensor,
+            B: torch.Tensor,
+            k: Optional[int] = None,
+            threshold: Optional[float] = None,
+            block_size: int = 1024
+        ) -> torch.Tensor:
+        """Compute the dot product similarity matrix of two embedding matrices tile by tile, keeping only the k highest
+        similarities of each row and/or those above a threshold, so that the dense matrix is never built.
+        Each tile is reduced as soon as it is computed: to the similarities above the threshold, and to the
+        running k highest of each row, merged with those of the previous tiles. At most one tile of
+        block_size x block_size similarities and k candidates per row are held at once, besides the result.
+        Args:
+            A: The first embeddings, n x embedding_dim.
+            B: The second embeddings, m x embedding_dim.
+            k: The number of similarities kept for each row; None to keep all those above threshold.
+            threshold: The minimum similarity kept; None to keep the k highest whatever their value.
+            block_size: The number of rows and of columns of the tiles.
+
+        Returns:
+            A sparse COO tensor, n x m, with the similarities kept, coalesced.
+        """
+        if k is None and threshold is None:
+            raise ValueError("topk_dot() needs k, threshold or both.")
+        n, m = A.size(0), B.size(0)
+        rows, cols, values = [], [], []
+        for row_start in range(0, n, block_size):
+            A_block = A[row_start:row_start + block_size]
+            top_values = top_cols = None  # the running k highest similarities of each row of the block
+            for col_start in range(0, m, block_size):
+                S = torch.mm(A_block, B[col_start:col_start + block_size].T)  # block rows x block columns
+                if k is None:
+                    # threshold only: keep the indices and values above it, nothing else of the tile
+                    tile_rows, tile_cols = torch.nonzero(S >= threshold, as_tuple=True)
+                    rows.append(tile_rows + row_start)
+                    cols.append(tile_cols + col_start)
+                    values.append(S[tile_rows, tile_cols])
+                    continue
+                S, tile_cols = S.topk(min(k, S.size(1)), dim=1)
+                tile_cols = tile_cols + col_start
+                if top_values is None:
+                    top_values, top_cols = S, tile_cols
+                else:
+                    merged_values, merged_cols = torch.cat([top_values, S], 1), torch.cat([top_cols, tile_cols], 1)
+                    top_values, top = merged_values.topk(min(k, merged_values.size(1)), dim=1)
+                    top_cols = merged_cols.gather(1, top)
+            if top_values is None:
+                continue
+            keep = top_values >= threshold if threshold is not None else torch.ones_like(top_values, dtype=torch.bool)
+            tile_rows, tile_ranks = torch.nonzero(keep, as_tuple=True)
+            rows.append(tile_rows + row_start)
+            cols.append(top_cols[tile_rows, tile_ranks])
+            values.append(top_values[tile_rows, tile_ranks])
+        if not values:
+            indices = torch.zeros(2, 0, dtype=torch.long, device=A.device)
+            return torch.sparse_coo_tensor(indices, torch.zeros(0, dtype=A.dtype, device=A.device), (n, m)).coalesce()
+        indices = torch.stack([torch.cat(rows), torch.cat(cols)])
+        return torch.sparse_coo_tensor(indices, torch.cat(values), (n, m)).coalesce()
+
+    def compare_dot_blocks(self, paras_1: List[List[str]], paras_2: List[List[str]]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Compare many pairs of lists of paragraphs at once, as compare_dot() on each pair. All the paragraphs
+        are embedded with one call per embedder, and the similarity matrices are computed by block_dot().
+        Args:
+            paras_1: The first lists of paragraphs of each pair.
+            paras_2: The second lists of paragraphs of each pair.
+
+        Returns:
+            The flattened similarity matrices of all pairs concatenated, and the offsets of each pair in it (see block_dot()).
+        """
+        assert len(paras_1) == len(paras_2), "The number of examples in the two lists must be the same."
+        A = self.embedder[0].get_embedding([p for paras in paras_1 for p in paras])
+        B = self.embedder[1].get_embedding([p for paras in paras_2 for p in paras])
+        blocks_1 = torch.split(A, [len(paras) for paras in paras_1])
+        blocks_2 = torch.split(B, [len(paras) for paras in paras_2])
+        return self.block_dot(blocks_1, blocks_2)
+
+    @staticmethod
+    def block_dot(blocks_1: List[torch.Tensor], blocks_2: List[torch.Tensor], pairs_per_batch: int = 256) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Compute the dot product similarity matrices of many pairs of embedding blocks of different sizes with a few
+        batched matrix multiplications, without going through python lists of scores.
+        Pairs are bucketed by their shape, with each dimension rounded up to a power of two, and sorted by shape within
+        a bucket; the pairs of a batch are from the same bucket, so that they are padded to less than twice their size.
+        Up to pairs_per_batch pairs are padded to the same shape and multiplied together.
+        Args:
+            blocks_1: The first embedding block of each pair, n_i x embedding_dim.
+            blocks_2: The second embedding block of each pair, m_i x embedding_dim.
+            pairs_per_batch: The maximum number of pairs multiplied together.
+
+        Returns:
+            A flat tensor with the similarity matrix of each pair flattened row by row, as torch.mm(A, B.T).view(-1),
+            concatenated in the order of the pairs; and the offsets of each pair in it, so that the scores of
+            pair i are scores[offsets[i]:offsets[i + 1]].
+        """
+        assert len(blocks_1) == len(blocks_2), "The number of examples in the two lists must be the same."
+        device = blocks_1[0].device if len(blocks_1) > 0 else None
+        shapes = [(block_1.size(0), block_2.size(0)) for block_1, block_2 in zip(blocks_1, blocks_2)]
+        sizes_1 = torch.tensor([n for n, _ in shapes], dtype=torch.long, device=device)
+        sizes_2 = torch.tensor([m for _, m in shapes], dtype=torch.long, device=device)
+        sizes = sizes_1 * sizes_2
+        offsets = torch.zeros(len(blocks_1) + 1, dtype=torch.long, device=device)
+        offsets[1:] = torch.cumsum(sizes, 0)
+        if len(blocks_1) == 0 or offsets[-1] == 0:
+            return torch.zeros(0, device=device), offsets
+        scores = torch.empty(int(offsets[-1]), dtype=blocks_1[0].dtype, device=device)
+        # pairs without scores are left out, the others are grouped by padded shape
+        buckets: Dict[Tuple[int, int], List[int]] = {}
+        for i in sorted((i for i, (n, m) in enumerate(shapes) if n * m > 0), key=lambda i: shapes[i]):
+            n, m = shapes[i]
+            buckets.setdefault((1 << (n - 1).bit_length(), 1 << (m - 1).bit_length()), []).append(i)
+        batches = [bucket[start:start + pairs_per_batch] for bucket in buckets.values() for start in range(0, len(bucket), pairs_per_batch)]
+        for batch in batches:
+            idx = torch.tensor(batch, dtype=torch.long, device=device)
+            batch_sizes = sizes[idx]
+            A = pad_sequence([blocks_1[i] for i in batch], batch_first=True)  # G x max n x D
+            B = pad_sequence([blocks_2[i] for i in batch], batch_first=True)  # G x max m x D
+            S = torch.bmm(A, B.transpose(1, 2))  # G x max n x max m
+            rows = torch.arange(S.size(1), device=device)[None, :, None] < sizes_1[idx][:, None, None]
+            cols = torch.arange(S.size(2), device=device)[None, None, :] < sizes_2[idx][:, None, None]
+            values = S[rows & cols]  # the unpadded scores of each pair, row by row, in the order of the batch
+            # move the scores of each pair of the batch to its offset
+            batch_starts = torch.cumsum(batch_sizes, 0) - batch_sizes
+            destination = torch.repeat_interleave(offsets[idx] - batch_starts, batch_sizes) + torch.arange(values.numel(), device=device)
+            scores[destination] = values
+        return scores, offsets
+
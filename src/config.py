@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Dict
+from typing import Any, Dict, List
 
 """Application-wide preferences"""
 
@@ -9,25 +9,90 @@ class Config:
     """Application-wide preferences.
 
     Fields:
-        embedding_model: The model to use for the embedding.
+        min_length: Minimum length of the chunks of text kept for embedding.
+        extra_boilerplate: Strings marking chunks as boilerplate to leave out, in addition to utils.BOILERPLATE.
+        embedding_model: The model to use for the embedding, and the backend running the Barlow model
+            ('barlow_backend': 'fp32', 'int8' or 'onnx', see LatentEmbedding).
+        embedding_ctx_length: Maximum number of tokens of an input to the OpenAI embedding model; longer inputs are truncated.
+        embedding_encoding: The tiktoken encoding of the OpenAI embedding model, used to count tokens locally.
+        openai_batch: Budget of each OpenAI embedding request ('max_tokens', 'max_items') and number of requests in flight ('max_workers').
+        openai_rate_limits: Quotas of the OpenAI account, in requests ('rpm') and tokens ('tpm') per minute.
+        api_max_workers: Number of requests to the EEB and bioRxiv APIs in flight at once, and of connections kept alive per host.
+        http_cache_dir: Directory of the on-disk cache of API and JATS XML responses; empty string to disable it.
+        http_cache_ttl: Age in seconds after which a cached response is revalidated with the server.
+        http_cache_max_size: Maximum size in bytes of the response cache; least recently used entries are evicted beyond it.
+        jats_dtd_dir: Directory with the complete JATS Journal Publishing DTD suite (the DTD and all its .ent modules)
+            used to resolve entities in JATS XML; empty string to parse without loading any DTD.
+        barlow_batch_size: Number of inputs encoded together by the Barlow twin encoder.
+        barlow_dynamic_padding: Whether to pad each batch of the Barlow twin encoder to its longest input (rounded up to a multiple of 8)
+            instead of to the full sequence length; only possible for encoders with latent_type 'mean', and slightly changes their
+            embeddings since the pretrained encoder attends to padding tokens.
+        barlow_num_threads: Number of intra-op threads used by torch on CPU for Barlow embeddings; 0 to keep the torch default.
+        embedding_cache_path: Path of the on-disk cache of embeddings shared by all embedders; empty string to disable it.
+        embedding_cache_dtype: Precision of the cached embedding vectors, 'float16' or 'float32'.
+        embedding_cache_max_size: Maximum size in bytes of the cached vectors; least recently used entries are evicted beyond it.
+        corpus_cache_size: Number of reviewed preprints kept in memory by a lazy Corpus.
+        corpus_mmap_size: Maximum number of bytes of a columnar corpus store that are memory-mapped when read lazily.
+        chunk_index_path: Path of the on-disk index of the chunks of the preprints and reviews; empty string to disable it.
+        sentence_splitter: The spaCy pipeline that splits sentences ('components': 'parser' or the faster 'senter', see
+            utils.SENTENCE_PIPELINES), the number of texts it processes together ('batch_size') and its number of processes ('n_process').
     """
     min_length: int
+    extra_boilerplate: List[str]
     embedding_model: Dict[str, str]
-    # embedding_ctx_length: int
-    # embedding_encoding: str
+    embedding_ctx_length: int
+    embedding_encoding: str
+    openai_batch: Dict[str, int]
+    openai_rate_limits: Dict[str, int]
     sections: str
+    api_max_workers: int
+    http_cache_dir: str
+    http_cache_ttl: int
+    http_cache_max_size: int
+    jats_dtd_dir: str
+    barlow_batch_size: int
+    barlow_dynamic_padding: bool
+    barlow_num_threads: int
+    embedding_cache_path: str
+    embedding_cache_dtype: str
+    embedding_cache_max_size: int
+    corpus_cache_size: int
+    corpus_mmap_size: int
+    chunk_index_path: str
+    sentence_splitter: Dict[str, Any]
 
 
 config = Config(
     min_length=10,
+    extra_boilerplate=[],
     embedding_model={
         # https://platform.openai.com/docs/models/gpt-3
         "openai": "text-embedding-ada-002",  # "text-embedding-ada-002", "text-similarity-curie-001", "text-similarity-babbage-001", "text-similarity-davinci-001", 
         # https://www.sbert.net/docs/pretrained_models.html
         "sbert": "all-mpnet-base-v2",  #"all-MiniLM-L6-v2", "all-mpnet-base-v2", "multi-qa-mpnet-base-dot-v1","text-embedding-ada-002"
         "barlow": "/pretrained/twin-no-lm-diag-diag", # "/app/pretrained/twin-no-lm-checkpoint-32000", "/app/pretrained/twin-lm-checkpoint-32000"
+        "barlow_backend": "fp32",  # "fp32", "int8", "onnx" (needs encoders exported with export_encoders(onnx=True))
     },
-    # embedding_ctx_length=8191,
-    # embedding_encoding="cl100k_base",
+    embedding_ctx_length=8191,
+    embedding_encoding="cl100k_base",
+    openai_batch={"max_tokens": 100_000, "max_items": 2048, "max_workers": 8},
+    openai_rate_limits={"rpm": 3_000, "tpm": 1_000_000},
     sections="introduction+results+discussion+methods",
+    api_max_workers=8,
+    http_cache_dir="/root/.cache/profrev/http",  # persisted by the cache volume in docker-compose.yml
+    http_cache_ttl=7 * 24 * 3600,
+    http_cache_max_size=2 * 1024 ** 3,
+    # the JATS-journalpublishing1.dtd shipped in the repo lacks its modules and cannot be loaded on its own;
+    # named entities are dropped without a DTD, as they were when the DTD was not found
+    jats_dtd_dir="",
+    barlow_batch_size=32,
+    barlow_dynamic_padding=False,
+    barlow_num_threads=0,
+    embedding_cache_path="/root/.cache/profrev/embeddings.sqlite",
+    embedding_cache_dtype="float16",
+    embedding_cache_max_size=4 * 1024 ** 3,
+    corpus_cache_size=256,
+    corpus_mmap_size=1024 ** 3,
+    chunk_index_path="/root/.cache/profrev/chunks.sqlite",
+    sentence_splitter={"components": "parser", "batch_size": 64, "n_process": 1},
 )
@@ -1,8 +1,81 @@
-from typing import List
+from typing import List, Dict, Iterable, Callable, Sequence, Union, Tuple, Collection
 from pathlib import Path
+from functools import lru_cache
+from itertools import chain
+from shutil import rmtree
+import json
+import re
 
 from .reviewed_preprint import ReviewedPreprint
-from .utils import doi_str_re
+from .api_tools import EEB, BioRxiv, map_concurrently
+from .corpus_store import CorpusStore
+from .utils import doi_str_re, stringify_doi
+from .config import config
+
+
+class IngestionManifest:
+    """An append-only log of the DOIs processed by Corpus.ingest(), kept next to the corpus on disk.
+
+    Each line is a json record {"doi": ..., "status": "completed" | "failed", "error": ...};
+    the last record of a DOI wins.
+
+    Attributes:
+        path: The path to the manifest file.
+        status: The current status of each DOI seen so far.
+    """
+
+    filename = 'manifest.jsonl'
+
+    def __init__(self, directory: Path):
+        self.path = Path(directory) / self.filename
+        self.status: Dict[str, str] = {}
+        if self.path.exists():
+            with open(self.path, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.status[record['doi']] = record['status']
+
+    def record(self, doi: str, status: str, error: str = ''):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({"doi": doi, "status": status, "error": error}) + '\n')
+        self.status[doi] = status
+
+    def pending(self, doi_list: Iterable[str], retry_failed: bool = False) -> List[str]:
+        """Return the DOIs that still need to be ingested, in their original order and without duplicates."""
+        skip = {'completed'} if retry_failed else {'completed', 'failed'}
+        return list(dict.fromkeys(doi for doi in doi_list if self.status.get(doi) not in skip))
+
+    @property
+    def completed(self) -> List[str]:
+        return [doi for doi, status in self.status.items() if status == 'completed']
+
+    @property
+    def failed(self) -> List[str]:
+        return [doi for doi, status in self.status.items() if status == 'failed']
+
+
+class LazyReviewedPreprints(Sequence):
+    """A read-only sequence of reviewed preprints that are materialized only when accessed.
+
+    Only the keys of the reviewed preprints are held up front; an item is built by the loader on access
+    and the most recently used ones are kept in a LRU cache, so that memory does not grow with the size of the corpus.
+
+    Attributes:
+        keys: The keys passed to the loader, one per reviewed preprint.
+    """
+    def __init__(self, keys: List, loader: Callable[..., ReviewedPreprint], cache_size: int = config.corpus_cache_size):
+        self.keys = keys
+        self._load = lru_cache(maxsize=cache_size)(loader)
+
+    def __getitem__(self, i: Union[int, slice]) -> Union[ReviewedPreprint, List[ReviewedPreprint]]:
+        if isinstance(i, slice):
+            return [self._load(key) for key in self.keys[i]]
+        return self._load(self.keys[i])
+
+    def __len__(self):
+        return len(self.keys)
+
 
 # a class to create a corpus of reviewed preprints from a list of DOIs
 class Corpus:
@@ -20,18 +93,188 @@ class Corpus:
         for reviewed_preprint in self.reviewed_preprints:
             reviewed_preprint.save(directory)
 
-    def from_dir(self, directory: Path):
+    def from_dir(self, directory: Path, lazy: bool = False):
         """Load the corpus from a directory that contains reviewed preprints.
         Each reviewed preprint is in a directory named after its DOI.
         Args:
             directory: The directory that contains the reviewed preprint.
+            lazy: Whether to only index the DOIs and load each reviewed preprint from disk when it is accessed.
         """
         # doi_str_match matches a stringified DOI, whereby the doit are underscore and slash are hyphens
         doi_dir_list = [d for d in Path(directory).iterdir() if d.is_dir() and doi_str_re.match(d.name)]
-        self.reviewed_preprints = [ReviewedPreprint().from_dir(d) for d in doi_dir_list]
-        doi_list = [reviewed_preprint.doi for reviewed_preprint in self.reviewed_preprints]
-        self.doi_list = doi_list
+        if lazy:
+            self.reviewed_preprints = LazyReviewedPreprints(doi_dir_list, lambda d: ReviewedPreprint().from_dir(d))
+            self.doi_list = [self._doi_from_dir(d) for d in doi_dir_list]
+        else:
+            self.reviewed_preprints = [ReviewedPreprint().from_dir(d) for d in doi_dir_list]
+            self.doi_list = [reviewed_preprint.doi for reviewed_preprint in self.reviewed_preprints]
         return self
-    
+
+    @staticmethod
+    def _doi_from_dir(directory: Path) -> str:
+        # the DOI cannot be recovered from the stringified directory name, but the preprint metadata is small
+        with open(directory / 'preprint' / 'metadata.json', 'r') as f:
+            return json.load(f)['doi']
+
+    def save_columnar(self, path: Path):
+        """Save the corpus to a single columnar store file (see CorpusStore).
+        Args:
+            path: The path to the store file.
+        """
+        CorpusStore(path).write(self.reviewed_preprints)
+
+    def load_columnar(self, path: Path, lazy: bool = False):
+        """Load the corpus from a columnar store file written by save_columnar().
+        Args:
+            path: The path to the store file.
+            lazy: Whether to only index the DOIs and read each reviewed preprint from the memory-mapped store when it is accessed.
+        """
+        store = CorpusStore(path, create=False)
+        if lazy:
+            self.doi_list = store.dois()
+            self.reviewed_preprints = LazyReviewedPreprints(self.doi_list, store.read_one)
+        else:
+            self.reviewed_preprints = store.read()
+            self.doi_list = [reviewed_preprint.doi for reviewed_preprint in self.reviewed_preprints]
+        return self
+
+    def ingest(self, doi_list: List[str], directory: Path, max_workers: int = config.api_max_workers, retry_failed: bool = False, streaming: bool = False):
+        """Build the corpus from a list of DOIs with a pool of workers, saving each reviewed preprint as soon as it is ready.
+        Progress is recorded in an IngestionManifest in the directory, so that an interrupted run resumes
+        where it stopped: DOIs already completed (and, unless retry_failed is set, those that failed) are skipped.
+        A DOI that fails does not abort the run; its error is logged in the manifest.
+        Args:
+            doi_list: The DOIs of the reviewed preprints.
+            directory: The directory to save the corpus in.
+            max_workers: The number of DOIs fetched, parsed and saved concurrently.
+            retry_failed: Whether to retry the DOIs that failed in a previous run.
+            streaming: Whether to parse the JATS XML incrementally, to bound the memory of each worker.
+        Returns:
+            The corpus loaded with the reviewed preprints of doi_list completed so far.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        manifest = IngestionManifest(directory)
+        pending = manifest.pending(doi_list, retry_failed)
+        self._process(pending, lambda doi: self._ingest_one(doi, directory, streaming), manifest, max_workers, action='ingest')
+        completed = set(manifest.completed)
+        self.reviewed_preprints = [ReviewedPreprint().from_dir(directory / stringify_doi(doi)) for doi in dict.fromkeys(doi_list) if doi in completed]
+        self.doi_list = [reviewed_preprint.doi for reviewed_preprint in self.reviewed_preprints]
+        return self
+
+    def sync(self, directory: Path, max_workers: int = config.api_max_workers, retry_failed: bool = False, streaming: bool = False, per_page: int = 100):
+        """Bring a corpus saved in a directory up to date with the feed of refereed preprints of the Early Evidence Base.
+        Only the DOIs that are new, that have new reviews (later posting date) or whose reviews are on a newer
+        version of the preprint are fetched; each of them replaces its previous copy in the directory once it is
+        completely saved, so that a failure leaves the previous copy untouched. Progress is recorded in the
+        IngestionManifest of the directory, as by ingest().
+        Args:
+            directory: The directory of the corpus.
+            max_workers: The number of DOIs fetched, parsed and saved concurrently.
+            retry_failed: Whether to retry the new DOIs that failed in a previous run.
+            streaming: Whether to parse the JATS XML incrementally, to bound the memory of each worker.
+            per_page: The number of refereed preprints requested per page of the feed.
+        Returns:
+            The corpus loaded with all the reviewed preprints of the directory.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        manifest = IngestionManifest(directory)
+        local_state = self._local_state(directory)
+        new, updated = [], []
+        for record in self._feed(per_page):
+            doi = record['doi']
+            posting_date, version = self._review_state(record['review_process']['reviews'])
+            if doi not in local_state:
+                new.append(doi)
+            elif posting_date > local_state[doi][0] or version > local_state[doi][1]:
+                updated.append(doi)
+        pending = manifest.pending(new, retry_failed) + updated
+        print(f"Syncing {len(pending)} DOIs ({len(new)} new, {len(updated)} updated).")
+        staging = directory / '.sync'
+        # the cached API responses of the DOIs known to have changed are revalidated; an updated DOI that fails keeps its previous, completed copy
+        self._process(pending, lambda doi: self._sync_one(doi, directory, staging, streaming), manifest, max_workers, revalidate=True, previous=local_state, action='sync')
+        rmtree(staging, ignore_errors=True)
+        # all the reviewed preprints of the directory, including those saved before or outside of the manifest
+        return self.from_dir(directory)
+
+    @staticmethod
+    def _process(pending: List[str], process_one: Callable[[str], None], manifest: IngestionManifest, max_workers: int, revalidate: bool = False, previous: Collection[str] = (), action: str = 'ingest'):
+        """Fetch the EEB and bioRxiv responses of the pending DOIs in bulk into the response cache, then process each DOI
+        whose responses were fetched with a pool of workers, recording the outcome of each DOI in the manifest as soon as it is known.
+        Args:
+            pending: The DOIs to process.
+            process_one: The function that fetches, parses and saves one reviewed preprint, served from the response cache.
+            manifest: The manifest of the corpus.
+            max_workers: The number of DOIs fetched or processed concurrently.
+            revalidate: Whether to revalidate the cached API responses with the servers.
+            previous: The DOIs that already have a completed copy, which are not recorded as failed.
+            action: The name of the action in the error messages.
+        """
+        reports = EEB().get_many(pending, max_workers, revalidate)
+        preprints = BioRxiv().get_many(pending, max_workers, revalidate)
+        errors = {doi: next((r for r in responses if isinstance(r, Exception)), None) for doi, *responses in zip(pending, reports, preprints)}
+        fetched = [doi for doi in pending if errors[doi] is None]
+        not_fetched = [(doi, errors[doi]) for doi in pending if errors[doi] is not None]
+        for doi, result in chain(not_fetched, map_concurrently(process_one, fetched, max_workers)):
+            if isinstance(result, Exception):
+                print(f"Failed to {action} {doi}: {result!r}")
+                if doi not in previous:
+                    manifest.record(doi, 'failed', repr(result))
+            else:
+                manifest.record(doi, 'completed')
+
+    @staticmethod
+    def _feed(per_page: int = 100) -> Iterable[Dict]:
+        """Iterate over all the refereed preprints of the Early Evidence Base feed."""
+        eeb = EEB()
+        page = 1
+        while True:
+            records = eeb.get_refereed_preprints(page, per_page)
+            if not records:
+                break
+            yield from records
+            page += 1
+
+    @staticmethod
+    def _review_state(reviews: List[Dict]) -> Tuple[str, int]:
+        """The latest posting date of the reviews and the latest version of the preprint they refer to."""
+        posting_date = max((review['posting_date'] for review in reviews), default='')
+        versions = [re.search(r'v(\d+)$', review['related_article_uri']) for review in reviews]
+        version = max((int(v.group(1)) for v in versions if v is not None), default=0)
+        return posting_date, version
+
+    @classmethod
+    def _local_state(cls, directory: Path) -> Dict[str, Tuple[str, int]]:
+        """The review state of each reviewed preprint saved in the directory, read from the review files only."""
+        local_state = {}
+        doi_dir_list = [d for d in directory.iterdir() if d.is_dir() and doi_str_re.match(d.name)]
+        for doi_dir in doi_dir_list:
+            reviews = []
+            for review_file in (doi_dir / 'review_process').glob('*/review.json'):
+                with open(review_file, 'r') as f:
+                    reviews.append(json.load(f))
+            if reviews:
+                local_state[reviews[0]['related_article_doi']] = cls._review_state(reviews)
+        return local_state
+
+    @classmethod
+    def _sync_one(cls, doi: str, directory: Path, staging: Path, streaming: bool = False):
+        cls._ingest_one(doi, staging, streaming)
+        doi_dir = directory / stringify_doi(doi)
+        rmtree(doi_dir, ignore_errors=True)
+        (staging / stringify_doi(doi)).rename(doi_dir)
+
+    @staticmethod
+    def _ingest_one(doi: str, directory: Path, streaming: bool = False):
+        # fetch and parse the review process and the preprint
+        reviewed_preprint = ReviewedPreprint(doi, streaming=streaming)
+        # save; a partially written DOI directory is removed so that it is never loaded
+        try:
+            reviewed_preprint.save(directory)
+        except Exception:
+            rmtree(directory / stringify_doi(doi), ignore_errors=True)
+            raise
+
     def __len__(self):
         return len(self.doi_list)
@@ -0,0 +1,130 @@
+from typing import List, Dict, Tuple, Callable, Optional
+from pathlib import Path
+import torch
+
+from .corpus import Corpus
+from .embed import Embedder
+from .chunk_index import CHUNK_INDEX
+from .config import config
+
+
+"""Embeddings of all the chunks of a corpus, computed once and indexed by DOI, section and review."""
+
+
+class CorpusEmbeddings:
+    """The embeddings of every chunk of the preprint sections and of the reviews of a corpus, each kind in one
+    contiguous matrix, with the offsets of the rows of each section of each preprint and of each review.
+
+    Attributes:
+        sections: The sections of the preprints that are embedded, combined with '+'.
+        dois: The DOIs of the reviewed preprints, in the order of the corpus.
+        preprint_embeddings: The embeddings of the chunks of the preprint sections, num_chunks x embedding_dim.
+        review_embeddings: The embeddings of the chunks of the reviews, num_chunks x embedding_dim.
+        section_offsets: For each DOI and section, the (start, end) rows of its chunks in preprint_embeddings.
+        review_offsets: For each DOI, the (start, end) rows of the chunks of each of its reviews in review_embeddings.
+    """
+    def __init__(
+            self,
+            sections: str,
+            dois: List[str],
+            preprint_embeddings: torch.Tensor,
+            review_embeddings: torch.Tensor,
+            section_offsets: Dict[str, Dict[str, Tuple[int, int]]],
+            review_offsets: Dict[str, List[Tuple[int, int]]],
+        ):
+        self.sections = sections
+        self.dois = dois
+        self.preprint_embeddings = preprint_embeddings
+        self.review_embeddings = review_embeddings
+        self.section_offsets = section_offsets
+        self.review_offsets = review_offsets
+
+    @classmethod
+    def from_corpus(
+            cls,
+            corpus: Corpus,
+            preprint_embedder: Embedder,
+            review_embedder: Embedder,
+            preprint_chunking_fn: Callable,
+            review_chunking_fn: Callable,
+            sections: str = config.sections,
+        ) -> "CorpusEmbeddings":
+        """Chunk and embed every preprint section and every review of a corpus, each embedder being called once.
+        Args:
+            corpus: The corpus.
+            preprint_embedder: The embedder of the preprint chunks.
+            review_embedder: The embedder of the review chunks.
+            preprint_chunking_fn: The function to chunk the preprint sections.
+            review_chunking_fn: The function to chunk the reviews.
+            sections: The sections of the preprints to embed, combined with '+'.
+        Returns:
+            The embeddings of the corpus.
+        """
+        dois = []
+        # the texts of the whole corpus are collected first so that each chunking function is called once on all of them
+        section_texts: List[str] = []
+        section_keys: List[Tuple[str, str]] = []
+        review_texts: List[str] = []
+        review_keys: List[Tuple[str, str]] = []
+        review_dois: List[str] = []
+        for rev_preprint in corpus.reviewed_preprints:
+            doi = rev_preprint.doi
+            dois.append(doi)
+            if rev_preprint.preprint is not None:
+                for section in sections.split('+'):
+                    section_texts.append(rev_preprint.preprint.sections[section])
+                    section_keys.append((doi, section))
+            if rev_preprint.review_process is not None:
+                for review in rev_preprint.review_process.reviews:
+                    review_texts.append(review.text)
+                    review_keys.append(review.chunk_key)
+                    review_dois.append(doi)
+
+        preprint_chunks: List[str] = []
+        review_chunks: List[str] = []
+        section_offsets: Dict[str, Dict[str, Tuple[int, int]]] = {doi: {} for doi in dois}
+        review_offsets: Dict[str, List[Tuple[int, int]]] = {doi: [] for doi in dois}
+        # the chunks of combined sections are the concatenation of the chunks of each section (see Preprint.get_chunks)
+        for (doi, section), chunks in zip(section_keys, CHUNK_INDEX.get_chunks(preprint_chunking_fn, section_keys, section_texts)):
+            section_offsets[doi][section] = (len(preprint_chunks), len(preprint_chunks) + len(chunks))
+            preprint_chunks += chunks
+        for doi, chunks in zip(review_dois, CHUNK_INDEX.get_chunks(review_chunking_fn, review_keys, review_texts)):
+            review_offsets[doi].append((len(review_chunks), len(review_chunks) + len(chunks)))
+            review_chunks += chunks
+        preprint_embeddings = preprint_embedder.get_embedding(preprint_chunks).cpu()
+        review_embeddings = review_embedder.get_embedding(review_chunks).cpu()
+        return cls(sections, dois, preprint_embeddings, review_embeddings, section_offsets, review_offsets)
+
+    def preprint(self, doi: str, sections: Optional[str] = None) -> torch.Tensor:
+        """The embeddings of the chunks of sections of a preprint.
+        Args:
+            doi: The DOI of the preprint.
+            sections: The sections, combined with '+'; by default all the sections that were embedded.
+        Returns:
+            The embeddings, in the order of Preprint.get_chunks().
+        """
+        sections = sections or self.sections
+        blocks = [self.preprint_embeddings[slice(*self.section_offsets[doi][section])] for section in sections.split('+')]
+        return torch.cat(blocks) if len(blocks) > 1 else blocks[0]
+
+    def reviews(self, doi: str) -> List[torch.Tensor]:
+        """The embeddings of the chunks of each review of a preprint.
+        Args:
+            doi: The DOI of the preprint.
+        Returns:
+            The embeddings of each review, in the order of the review process.
+        """
+        return [self.review_embeddings[start:end] for start, end in self.review_offsets[doi]]
+
+    def has_preprint(self, doi: str) -> bool:
+        return bool(self.section_offsets.get(doi))
+
+    def save(self, path: Path):
+        """Save the embeddings and their index to a single file."""
+        torch.save(self.__dict__, path)
+
+    @classmethod
+    def load(cls, path: Path, mmap: bool = False) -> "CorpusEmbeddings":
+        """Load embeddings saved with save(); with mmap, the matrices are memory-mapped from the file instead of read,
+        so that processes loading the same file share its pages."""
+        return cls(**torch.load(path, mmap=mmap))
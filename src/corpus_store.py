@@ -0,0 +1,142 @@
+from typing import List, Dict, Iterable, Any
+from dataclasses import fields
+from pathlib import Path
+from threading import local
+import sqlite3
+import json
+
+from .reviewed_preprint import ReviewedPreprint
+from .review_process import ReviewProcess, Review
+from .preprint import Preprint, BioRxivMetadata
+from .sqlite_file import SQLiteFile
+from .config import config
+
+
+"""A columnar store of a corpus of reviewed preprints in a single SQLite file, with one table each for preprints, sections and reviews."""
+
+
+METADATA_FIELDS = [f.name for f in fields(BioRxivMetadata)]
+REVIEW_FIELDS = [f.name for f in fields(Review)]
+METADATA_COLUMNS = ', '.join(f'"{name}" TEXT' for name in METADATA_FIELDS)
+REVIEW_COLUMNS = ', '.join(f'"{name}" TEXT' for name in REVIEW_FIELDS)
+SCHEMA = f'''
+    CREATE TABLE IF NOT EXISTS preprints ({METADATA_COLUMNS}, PRIMARY KEY (doi));
+    CREATE TABLE IF NOT EXISTS sections (doi TEXT, section TEXT, content TEXT, PRIMARY KEY (doi, section));
+    CREATE TABLE IF NOT EXISTS reviews (preprint_doi TEXT, {REVIEW_COLUMNS}, PRIMARY KEY (preprint_doi, review_idx));
+'''
+
+
+class CorpusStore:
+    """A corpus of reviewed preprints stored in a single SQLite file.
+
+    Tables:
+        preprints: one row per preprint with its bioRxiv metadata, keyed by doi.
+        sections: one row per (doi, section) with the text of the section.
+        reviews: one row per (preprint_doi, review_idx) with the fields of the review.
+
+    Single reviewed preprints are read with read_one() through a memory-mapped connection kept open per thread,
+    so that random access by DOI is served from the page cache without copying the file in memory.
+
+    Attributes:
+        path: The path to the SQLite file.
+        mmap_size: Maximum number of bytes of the file that are memory-mapped by the readers.
+        create: Whether to create the file and its tables if they do not exist, to write to it; otherwise a missing
+            file raises FileNotFoundError, for example when reading a mistyped path.
+    """
+    def __init__(self, path: Path, mmap_size: int = config.corpus_mmap_size, create: bool = True):
+        self.path = Path(path)
+        self.mmap_size = mmap_size
+        self.create = create
+        self._readers = local()
+        self._file = SQLiteFile(self.path, SCHEMA if create else '', create=create)
+        self._file.connect().close()
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._readers, 'conn', None)
+        if conn is None:
+            conn = self._file.connect()
+            conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+            self._readers.conn = conn
+        return conn
+
+    def write(self, reviewed_preprints: Iterable[ReviewedPreprint]):
+        """Write reviewed preprints to the store in a single transaction, replacing any previous version of the same DOIs.
+        Args:
+            reviewed_preprints: The reviewed preprints to write.
+        """
+        preprint_rows, section_rows, review_rows, dois = [], [], [], []
+        for reviewed_preprint in reviewed_preprints:
+            preprint, review_process = reviewed_preprint.preprint, reviewed_preprint.review_process
+            if preprint is None or preprint.biorxiv_meta is None or review_process is None:
+                raise ValueError(f"Incomplete reviewed preprint {reviewed_preprint.doi}.")
+            doi = reviewed_preprint.doi
+            dois.append((doi,))
+            metadata = preprint.biorxiv_meta.asdict()
+            preprint_rows.append([metadata[name] for name in METADATA_FIELDS])
+            section_rows += [(doi, section, content) for section, content in preprint.sections.items()]
+            for review in review_process.reviews:
+                review_dict = review.asdict()
+                review_dict['tags'] = json.dumps(review_dict['tags'])
+                review_rows.append([doi] + [review_dict[name] for name in REVIEW_FIELDS])
+        with self._file.transaction() as conn:
+            conn.executemany('DELETE FROM sections WHERE doi = ?', dois)
+            conn.executemany('DELETE FROM reviews WHERE preprint_doi = ?', dois)
+            conn.executemany(f'INSERT OR REPLACE INTO preprints VALUES ({", ".join("?" * len(METADATA_FIELDS))})', preprint_rows)
+            conn.executemany('INSERT INTO sections VALUES (?, ?, ?)', section_rows)
+            conn.executemany(f'INSERT INTO reviews VALUES ({", ".join("?" * (len(REVIEW_FIELDS) + 1))})', review_rows)
+
+    def read(self) -> List[ReviewedPreprint]:
+        """Read all the reviewed preprints of the store, each table in one sequential scan.
+        Returns:
+            The reviewed preprints, ordered by DOI.
+        """
+        with self._file.transaction() as conn:
+            metadata_rows = conn.execute('SELECT * FROM preprints ORDER BY doi').fetchall()
+            sections: Dict[str, Dict[str, str]] = {}
+            for doi, section, content in conn.execute('SELECT doi, section, content FROM sections'):
+                sections.setdefault(doi, {})[section] = content
+            reviews: Dict[str, List[Review]] = {}
+            for row in conn.execute('SELECT * FROM reviews'):
+                reviews.setdefault(row[0], []).append(self._review(row[1:]))
+        return [self._reviewed_preprint(row, sections.get(row[0], {}), reviews.get(row[0], [])) for row in metadata_rows]
+
+    def dois(self) -> List[str]:
+        """The DOIs of the reviewed preprints in the store, read from the primary key index only.
+        Returns:
+            The DOIs, ordered as by read().
+        """
+        return [doi for doi, in self._reader().execute('SELECT doi FROM preprints ORDER BY doi')]
+
+    def read_one(self, doi: str) -> ReviewedPreprint:
+        """Read a single reviewed preprint of the store by DOI.
+        Args:
+            doi: The DOI of the reviewed preprint.
+        Returns:
+            The reviewed preprint.
+        """
+        conn = self._reader()
+        metadata_row = conn.execute('SELECT * FROM preprints WHERE doi = ?', (doi,)).fetchone()
+        if metadata_row is None:
+            raise KeyError(doi)
+        sections = dict(conn.execute('SELECT section, content FROM sections WHERE doi = ?', (doi,)).fetchall())
+        reviews = [self._review(row[1:]) for row in conn.execute('SELECT * FROM reviews WHERE preprint_doi = ?', (doi,))]
+        return self._reviewed_preprint(metadata_row, sections, reviews)
+
+    @staticmethod
+    def _review(row: Iterable[Any]) -> Review:
+        review_dict = dict(zip(REVIEW_FIELDS, row))
+        review_dict['tags'] = json.loads(review_dict['tags'])
+        return Review(**review_dict)
+
+    @staticmethod
+    def _reviewed_preprint(metadata_row: Iterable[Any], sections: Dict[str, str], reviews: List[Review]) -> ReviewedPreprint:
+        preprint = Preprint()
+        preprint.biorxiv_meta = BioRxivMetadata(data=dict(zip(METADATA_FIELDS, metadata_row)))
+        preprint.doi = preprint.biorxiv_meta.doi
+        preprint.sections = sections
+        review_process = ReviewProcess()
+        review_process.doi = preprint.doi
+        review_process.reviews = reviews
+        reviewed_preprint = ReviewedPreprint()
+        reviewed_preprint.from_objects(preprint, review_process)
+        return reviewed_preprint
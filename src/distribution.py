@@ -0,0 +1,126 @@
+"""Constant-memory accumulators of distributions of similarity scores, mergeable across workers."""
+from typing import List, Tuple, Union, Iterable
+import numpy as np
+
+
+
+class SimilarityDistribution:
+    """A distribution of similarity scores accumulated in a fixed-bin histogram over [low, high].
+
+    The histogram is fine enough to serve quantiles and cumulative probabilities with an absolute error below the bin
+    width, (high - low) / bins, while taking constant memory whatever the number of scores. Scores outside [low, high]
+    are counted apart and treated as being at the observed minimum or maximum. Accumulators with the same bins are
+    merged exactly, in any order, by merge().
+
+    Attributes:
+        bins: The number of bins.
+        low: The lower bound of the histogram.
+        high: The upper bound of the histogram.
+        counts: The number of scores in each bin.
+        n: The total number of scores.
+    """
+    def __init__(self, bins: int = 20_000, low: float = -1.0, high: float = 1.0):
+        self.bins = bins
+        self.low = low
+        self.high = high
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+        self.n = 0
+        self._sum = 0.0
+        self._sum_sq = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    @property
+    def edges(self) -> np.ndarray:
+        return np.linspace(self.low, self.high, self.bins + 1)
+
+    def update(self, scores: Union[np.ndarray, Iterable[float]]) -> "SimilarityDistribution":
+        """Add scores to the distribution.
+        Args:
+            scores: The scores.
+        Returns:
+            The distribution itself.
+        """
+        scores = np.asarray(scores, dtype=np.float64).ravel()
+        if scores.size == 0:
+            return self
+        inside = (scores >= self.low) & (scores <= self.high)
+        self.underflow += int((scores < self.low).sum())
+        self.overflow += int((scores > self.high).sum())
+        idx = ((scores[inside] - self.low) / (self.high - self.low) * self.bins).astype(np.int64)
+        self.counts += np.bincount(np.minimum(idx, self.bins - 1), minlength=self.bins)
+        self.n += scores.size
+        self._sum += float(scores.sum())
+        self._sum_sq += float(np.square(scores).sum())
+        self.min = min(self.min, float(scores.min()))
+        self.max = max(self.max, float(scores.max()))
+        return self
+
+    def merge(self, other: "SimilarityDistribution") -> "SimilarityDistribution":
+        """Add the scores of another distribution with the same bins.
+        Args:
+            other: The other distribution.
+        Returns:
+            The distribution itself.
+        """
+        assert (self.bins, self.low, self.high) == (other.bins, other.low, other.high), "Only distributions with the same bins can be merged."
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        self.n += other.n
+        self._sum += other._sum
+        self._sum_sq += other._sum_sq
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    @property
+    def mean(self) -> float:
+        return self._sum / self.n if self.n else np.nan
+
+    @property
+    def std(self) -> float:
+        return np.sqrt(max(self._sum_sq / self.n - self.mean ** 2, 0.0)) if self.n else np.nan
+
+    def histogram(self) -> Tuple[np.ndarray, np.ndarray]:
+        """The counts and the bin edges of the histogram, as np.histogram()."""
+        return self.counts.copy(), self.edges
+
+    def cdf(self, x: Union[float, np.ndarray]) -> Union[float, np.ndarray]:
+        """The fraction of scores lower than or equal to x, interpolated linearly within bins."""
+        x = np.asarray(x, dtype=np.float64)
+        cumulative = np.concatenate([[self.underflow], self.underflow + np.cumsum(self.counts)]) / self.n
+        fraction = np.interp(x, self.edges, cumulative)
+        return np.where(x >= self.max, 1.0, np.where(x < self.min, 0.0, fraction))
+
+    def quantile(self, q: Union[float, np.ndarray]) -> Union[float, np.ndarray]:
+        """The scores below which a fraction q of the scores lie, interpolated linearly within bins."""
+        q = np.asarray(q, dtype=np.float64)
+        cumulative = np.concatenate([[self.underflow], self.underflow + np.cumsum(self.counts)]) / self.n
+        values = np.interp(q, cumulative, self.edges)
+        # scores out of the histogram are taken to be at the observed extremes
+        if self.underflow:
+            values = np.where(q <= cumulative[0], self.min, values)
+        if self.overflow:
+            values = np.where(q >= cumulative[-1], self.max, values)
+        return np.clip(values, self.min, self.max)
+
+
+def bootstrap_band(
+        distributions: List[SimilarityDistribution],
+        q: Union[float, np.ndarray],
+        confidence: float = 0.95
+    ) -> Tuple[np.ndarray, np.ndarray]:
+    """The confidence band of quantiles of a distribution, from the distributions of replicate samples.
+    Args:
+        distributions: The distributions of the replicates, for example from Sampler.sample_parallel().
+        q: The fractions of the scores the quantiles are computed at.
+        confidence: The fraction of the replicate quantiles within the band.
+    Returns:
+        The lower and upper bounds of the band at each of q.
+    """
+    quantiles = np.stack([np.asarray(distribution.quantile(q)) for distribution in distributions])
+    alpha = (1 - confidence) / 2
+    return np.quantile(quantiles, alpha, axis=0), np.quantile(quantiles, 1 - alpha, axis=0)
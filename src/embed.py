@@ -1,83 +1,379 @@
 import torch
-from typing import List, Tuple, Dict
+import numpy as np
+from typing import List, Tuple, Dict, Optional, Iterator, TYPE_CHECKING
+from pathlib import Path
+from hashlib import sha256
+from threading import Lock
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import sqlite3
+import time
+import os
 from tenacity import retry, wait_random_exponential, stop_after_attempt
-import openai
-from sentence_transformers import SentenceTransformer, util
-
-from .models.barlow_embeddings import LatentEmbedding, LatentParagraphEmbedding, LatentSentenceEmbedding
 
+from .api_tools import RateLimiter
+from .sqlite_file import SQLiteFile
 from .config import config
+from . import configure_openai
+
+if TYPE_CHECKING:
+    # the model libraries take seconds to import; each embedder imports its own on construction
+    from sentence_transformers import SentenceTransformer
 
 OPENAI_MODEL = config.embedding_model['openai']
 SBERT_MODEL = config.embedding_model['sbert']
 BARLOW_MODEL = config.embedding_model['barlow']
 
+EMBEDDINGS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, dtype TEXT, vector BLOB, accessed REAL);
+    CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings (accessed);
+"""
+
+
+class EmbeddingCache:
+    """A persistent on-disk cache of embeddings in a SQLite file, addressed by the hash of the model and of the text.
+
+    The embedding of a chunk only depends on the model and on the text of the chunk, so entries computed for
+    one chunking function are reused by any other that yields the same chunk. Vectors are stored with the
+    precision dtype, and newly computed embeddings are returned rounded to it too, so that results do not depend
+    on whether they were cached; when they grow beyond max_size bytes, the least recently used entries are evicted.
+
+    Attributes:
+        path: The path to the SQLite file; None disables caching.
+        dtype: The precision of the stored vectors, 'float16' or 'float32'.
+        max_size: Maximum total size in bytes of the stored vectors.
+    """
+    def __init__(self, path: Optional[str] = config.embedding_cache_path, dtype: str = config.embedding_cache_dtype, max_size: int = config.embedding_cache_max_size):
+        self.path = Path(path) if path else None
+        self.dtype = np.dtype(dtype)
+        self.max_size = max_size
+        self._file = SQLiteFile(self.path, EMBEDDINGS_SCHEMA) if self.path else None
+        self._size: Optional[int] = None
+        self._lock = Lock()
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return sha256(f'{model}\0{text}'.encode('utf-8')).hexdigest()
+
+    def get(self, model: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Look up the embeddings of texts.
+        Args:
+            model: The identifier of the model that computed the embeddings.
+            texts: The texts.
+        Returns:
+            The float32 embedding of each text, or None if it is not in the cache.
+        """
+        keys = [self.key(model, text) for text in texts]
+        found: Dict[str, np.ndarray] = {}
+        with self._lock, self._file.transaction() as conn:
+            for i in range(0, len(keys), 500):  # stay below the limit on the number of SQL variables
+                batch = keys[i:i + 500]
+                query = f'SELECT key, dtype, vector FROM embeddings WHERE key IN ({", ".join("?" * len(batch))})'
+                for key, dtype, vector in conn.execute(query, batch):
+                    found[key] = np.frombuffer(vector, dtype=dtype).astype(np.float32)
+            now = time.time()
+            conn.executemany('UPDATE embeddings SET accessed = ? WHERE key = ?', [(now, key) for key in found])
+        return [found.get(key) for key in keys]
+
+    def put(self, model: str, texts: List[str], embeddings: np.ndarray) -> np.ndarray:
+        """Store the embeddings of texts.
+        Args:
+            model: The identifier of the model that computed the embeddings.
+            texts: The texts.
+            embeddings: The embeddings as rows, one for each text.
+        Returns:
+            The float32 embeddings as they are stored, rounded to the precision of the cache, so that
+            they are the same as those get() returns later.
+        """
+        stored = np.ascontiguousarray(embeddings, dtype=self.dtype)
+        now = time.time()
+        rows = [(self.key(model, text), self.dtype.name, embedding.tobytes(), now) for text, embedding in zip(texts, stored)]
+        with self._lock, self._file.transaction() as conn:
+            if self._size is None:
+                self._size = conn.execute('SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings').fetchone()[0]
+            # the vectors replaced, if another process stored the same texts meanwhile
+            for i in range(0, len(rows), 500):  # stay below the limit on the number of SQL variables
+                batch = [row[0] for row in rows[i:i + 500]]
+                query = f'SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings WHERE key IN ({", ".join("?" * len(batch))})'
+                self._size -= conn.execute(query, batch).fetchone()[0]
+            conn.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)', rows)
+            self._size += sum(len(row[2]) for row in rows)
+            if self._size > self.max_size:
+                self._evict(conn, self._size)
+        return stored.astype(np.float32)
+
+    def _evict(self, conn: sqlite3.Connection, size: int):
+        # least recently used first, down to 90% of max_size to avoid evicting on every store
+        evicted = []
+        for key, length in conn.execute('SELECT key, LENGTH(vector) FROM embeddings ORDER BY accessed'):
+            if size <= 0.9 * self.max_size:
+                break
+            evicted.append((key,))
+            size -= length
+        conn.executemany('DELETE FROM embeddings WHERE key = ?', evicted)
+        self._size = size
+
+
+EMBEDDING_CACHE = EmbeddingCache()
+
 
 class Embedder:
     """A abstract class to get embeddings from OpenAI Embedding API.
+
+    Embeddings already computed by the same model are served from the embedding cache;
+    only the other inputs are sent to the model by get_embedding().
+
     Attributes:
         model: The model to use for the embedding.
+        cache: The embedding cache; None to always compute the embeddings.
     """
-    def __init__(self, model: str = ""):
+    def __init__(self, model: str = "", cache: Optional[EmbeddingCache] = EMBEDDING_CACHE):
         self.model = model
+        self.cache = cache if cache is not None and cache.path is not None else None
 
-    @retry(wait=wait_random_exponential(multiplier=1, max=10), stop=stop_after_attempt(3))
-    def get_embedding(self, inputs: List[str]) ->  torch.Tensor:
+    @property
+    def cache_id(self) -> str:
+        """Identifies the model that computes the embeddings in the cache."""
+        return f"{type(self).__name__}:{self.model}"
+
+    def get_embedding(self, inputs: List[str]) -> torch.Tensor:
+        """Get embeddings for a list of strings, computing only those not yet in the cache.
+        Args:
+            inputs: A list of strings to get embeddings for.
+        Returns:
+            A tensor with embeddings as rows, one for each string in the input.
+        """
+        if self.cache is None or not inputs:
+            return self._embed(inputs)
+        embeddings = self.cache.get(self.cache_id, inputs)
+        misses = list(dict.fromkeys(text for text, embedding in zip(inputs, embeddings) if embedding is None))
+        if misses:
+            computed = self._embed(misses).detach().cpu().float().numpy()
+            # as stored, so that a text gets the same embedding whether it was cached or not
+            computed = self.cache.put(self.cache_id, misses, computed)
+            computed_by_text = dict(zip(misses, computed))
+            embeddings = [computed_by_text[text] if embedding is None else embedding for text, embedding in zip(inputs, embeddings)]
+        return torch.from_numpy(np.stack(embeddings).astype(np.float32))  # num_examples x embedding_dim
+
+    def _embed(self, inputs: List[str]) -> torch.Tensor:
         raise NotImplementedError
 
 
 class OpenAIEmbedder(Embedder):
     """A class to get open ai GPT embeddings.
+
+    Inputs are packed, in order, into requests within a budget of tokens counted locally and of items;
+    the requests are sent concurrently under the rate limiter shared by all instances, and a request
+    that fails is retried on its own.
+
     Attributes:
         model: The model to use for the embedding.
+        max_tokens: Maximum number of tokens of a request.
+        max_items: Maximum number of inputs of a request.
+        max_workers: Maximum number of requests in flight.
     """
-    def __init__(self, model: str = OPENAI_MODEL):
-        super().__init__(model)
+    rate_limiter = RateLimiter(**config.openai_rate_limits)
 
-    @retry(wait=wait_random_exponential(multiplier=1, max=10), stop=stop_after_attempt(3))
-    def get_embedding(self, inputs: List[str]) -> torch.Tensor:
+    def __init__(
+            self,
+            model: str = OPENAI_MODEL,
+            cache: Optional[EmbeddingCache] = EMBEDDING_CACHE,
+            max_tokens: int = config.openai_batch['max_tokens'],
+            max_items: int = config.openai_batch['max_items'],
+            max_workers: int = config.openai_batch['max_workers'],
+        ):
+        super().__init__(model, cache)
+        self.max_tokens = max_tokens
+        self.max_items = max_items
+        self.max_workers = max_workers
+        import tiktoken
+        self.encoding = tiktoken.get_encoding(config.embedding_encoding)
+        self.openai = configure_openai()
+
+    def _embed(self, inputs: List[str]) -> torch.Tensor:
         """Get embeddings for a list of strings.
         Args:
             input: A list of strings to get embeddings for.
         Returns:
             A tensor with embeddings as rows, one for each string in the input.
         """
-        results = openai.Embedding.create(input=inputs, model=self.model)
-        embeddings: List[List[float]] = [r['embedding'] for r in results['data']]
-        # results.pop('data')  # some metadata, not used for now
+        batches = self._batches(inputs)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = executor.map(self._embed_batch, batches)
+            embeddings: List[List[float]] = [embedding for batch_embeddings in results for embedding in batch_embeddings]
         embeddings = torch.Tensor(embeddings)
         return embeddings  # num_examples x embedding_dim
 
+    def _batches(self, inputs: List[str]) -> List[Tuple[List[str], int]]:
+        """Pack the inputs in order into batches within the token and item budgets, truncating inputs longer than the context.
+        Returns:
+            The batches, each with its inputs and its number of tokens.
+        """
+        batches = []
+        batch, batch_tokens = [], 0
+        for text in inputs:
+            tokens = self.encoding.encode(text)
+            if len(tokens) > config.embedding_ctx_length:
+                tokens = tokens[:config.embedding_ctx_length]
+                text = self.encoding.decode(tokens)
+            if batch and (batch_tokens + len(tokens) > self.max_tokens or len(batch) == self.max_items):
+                batches.append((batch, batch_tokens))
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += len(tokens)
+        if batch:
+            batches.append((batch, batch_tokens))
+        return batches
+
+    @retry(wait=wait_random_exponential(multiplier=1, max=10), stop=stop_after_attempt(3))
+    def _embed_batch(self, batch: Tuple[List[str], int]) -> List[List[float]]:
+        inputs, tokens = batch
+        self.rate_limiter.acquire(tokens)
+        results = self.openai.Embedding.create(input=inputs, model=self.model)
+        # results.pop('data')  # some metadata, not used for now
+        return [r['embedding'] for r in sorted(results['data'], key=lambda r: r['index'])]
+
+
+# the model of each worker process of an SBERTPool
+_sbert_worker_transformer: Optional["SentenceTransformer"] = None
+
+
+def _sbert_worker_init(model: str, threads: int):
+    global _sbert_worker_transformer
+    from sentence_transformers import SentenceTransformer
+    torch.set_num_threads(threads)
+    _sbert_worker_transformer = SentenceTransformer(model, device="cpu")
+    _sbert_worker_transformer.max_seq_length = 512
+
+
+def _sbert_worker_encode(inputs: List[str]) -> np.ndarray:
+    return _sbert_worker_transformer.encode(inputs, normalize_embeddings=True, convert_to_numpy=True)
+
+
+class SBERTPool:
+    """A pool of worker processes, each with its own copy of an SBERT model on CPU and a fixed number of torch threads,
+    that encodes large lists of inputs in chunks spread over the workers.
+
+    The workers are started by start() and stopped by close(), or by using the pool as a context manager.
+
+    Attributes:
+        model: The model to use for the embedding.
+        processes: The number of worker processes.
+        threads_per_process: The number of torch intra-op threads of each worker.
+        chunk_size: The number of inputs sent to a worker at once.
+    """
+    def __init__(self, model: str = SBERT_MODEL, processes: Optional[int] = None, threads_per_process: int = 2, chunk_size: int = 64):
+        self.model = model
+        self.threads_per_process = threads_per_process
+        self.processes = processes or max(1, (os.cpu_count() or 1) // threads_per_process)
+        self.chunk_size = chunk_size
+        self._pool = None
+
+    def start(self):
+        if self._pool is None:
+            # spawn rather than fork: torch and tokenizers threads do not survive a fork
+            context = multiprocessing.get_context("spawn")
+            self._pool = context.Pool(self.processes, initializer=_sbert_worker_init, initargs=(self.model, self.threads_per_process))
+        return self
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def iter_encode(self, inputs: List[str]) -> Iterator[np.ndarray]:
+        """Encode inputs in chunks over the workers.
+        Args:
+            inputs: A list of strings to get embeddings for.
+        Yields:
+            The embeddings of consecutive chunks of the inputs, in order, as soon as they are ready.
+        """
+        if self._pool is None:
+            raise RuntimeError("SBERTPool is not started")
+        chunks = [inputs[i:i + self.chunk_size] for i in range(0, len(inputs), self.chunk_size)]
+        yield from self._pool.imap(_sbert_worker_encode, chunks)
+
+    def encode(self, inputs: List[str]) -> np.ndarray:
+        """Encode inputs over the workers.
+        Args:
+            inputs: A list of strings to get embeddings for.
+        Returns:
+            An array with embeddings as rows, one for each string in the input.
+        """
+        return np.concatenate(list(self.iter_encode(inputs)))
+
 
 class SBERTEmbedder(Embedder):
     """A class to get embeddings from sentence transfomer SBERT.
+
+    Within the pool() context, embeddings are computed by an SBERTPool of worker processes instead of in-process.
+
     Attributes:
         model: The model to use for the embedding.
     """
-    def __init__(self, model: str = SBERT_MODEL):
-        super().__init__(model)
+    def __init__(self, model: str = SBERT_MODEL, cache: Optional[EmbeddingCache] = EMBEDDING_CACHE):
+        super().__init__(model, cache)
+        from sentence_transformers import SentenceTransformer
         self.transformer = SentenceTransformer(model)
         self.transformer.max_seq_length = 512
+        self._pool: Optional[SBERTPool] = None
+
+    @contextmanager
+    def pool(self, processes: Optional[int] = None, threads_per_process: int = 2, chunk_size: int = 64) -> Iterator["SBERTEmbedder"]:
+        """Compute embeddings with a pool of worker processes for the duration of the context.
+        Args:
+            processes: The number of worker processes; by default as many as fit the CPU cores with threads_per_process each.
+            threads_per_process: The number of torch intra-op threads of each worker.
+            chunk_size: The number of inputs sent to a worker at once.
+        Yields:
+            The embedder.
+        """
+        with SBERTPool(self.model, processes, threads_per_process, chunk_size) as pool:
+            self._pool = pool
+            try:
+                yield self
+            finally:
+                self._pool = None
 
     @retry(wait=wait_random_exponential(multiplier=1, max=10), stop=stop_after_attempt(3))
-    def get_embedding(self, inputs: List[str]) -> torch.Tensor:
+    def _embed(self, inputs: List[str]) -> torch.Tensor:
         """Get embeddings for a list of strings.
         Args:
             input: A list of strings to get embeddings for.
         Returns:
             A tensor with embeddings as rows, one for each string in the input.
         """
+        if self._pool is not None and inputs:
+            return torch.from_numpy(self._pool.encode(inputs))
         embeddings = self.transformer.encode(inputs, normalize_embeddings=True, convert_to_tensor=True)
         return embeddings  # num_examples x embedding_dim
-    
+
+
 class BarlowEmbedder(Embedder):
     """A class to get embeddings from Barlow Twins embeddings.
     """
-    def __init__(self, model: str = BARLOW_MODEL, mode: str = 'paragraph'):
-        super().__init__(model)
+    def __init__(self, model: str = BARLOW_MODEL, mode: str = 'paragraph', cache: Optional[EmbeddingCache] = EMBEDDING_CACHE):
+        super().__init__(model, cache)
+        self.mode = mode
+        from .models.barlow_embeddings import LatentEmbedding
         self.latent_encoder = LatentEmbedding(model, mode)
 
-    def get_embedding(self, inputs: List[str]) -> torch.Tensor:
+    @property
+    def cache_id(self) -> str:
+        # the sentence and paragraph encoders of the same twin model give different embeddings
+        padding = "-dynamic" if self.latent_encoder.dynamic_padding else ""
+        backend = f"-{self.latent_encoder.backend}" if self.latent_encoder.backend != "fp32" else ""
+        return f"BarlowEmbedder-{self.mode}{padding}{backend}:{self.model}"
+
+    def _embed(self, inputs: List[str]) -> torch.Tensor:
         """Get embeddings for a list of strings.
         Args:
             input: A list of strings to get embeddings for.
@@ -90,11 +386,11 @@ class BarlowEmbedder(Embedder):
 class BarlowSentenceEmbedder(BarlowEmbedder):
     """A class to get embeddings from Barlow Twins sentence embeddings.
     """
-    def __init__(self, model: str = BARLOW_MODEL):
-        super().__init__(model, mode='sentence')
+    def __init__(self, model: str = BARLOW_MODEL, cache: Optional[EmbeddingCache] = EMBEDDING_CACHE):
+        super().__init__(model, mode='sentence', cache=cache)
 
 class BarlowParagraphEmbedder(BarlowEmbedder):
     """A class to get embeddings from Barlow Twins paragraph embeddings.
     """
-    def __init__(self, model: str = BARLOW_MODEL):
-        super().__init__(model, mode='paragraph')   
\ No newline at end of file
+    def __init__(self, model: str = BARLOW_MODEL, cache: Optional[EmbeddingCache] = EMBEDDING_CACHE):
+        super().__init__(model, mode='paragraph', cache=cache)   
\ No newline at end of file
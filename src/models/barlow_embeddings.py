@@ -1,54 +1,171 @@
 import torch
-from typing import List
+from typing import List, Dict
+from pathlib import Path
 from torch import nn
 from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
 
-from .barlow_twin import Twin, TwinSEQ2SEQ, LatentEncoder
+from .barlow_twin import Twin, TwinSEQ2SEQ, LatentEncoder, LatentConfig, LATENT_ENCODER_WEIGHTS
 from ..config import config
 
 
 PRETRAINED_BARLOW = config.embedding_model['barlow']
+BARLOW_BACKEND = config.embedding_model['barlow_backend']
+LATENT_ENCODER_ONNX = "latent_encoder.onnx"
+MODES = ['sentence', 'paragraph']  # in the order of the encoders of the twin model
+
+
+def load_twin(pretrained_barlow: str) -> Twin:
+    """Load a full pretrained twin model, with or without language model.
+    Args:
+        pretrained_barlow: The directory of the pretrained twin model.
+    Returns:
+        The twin model.
+    """
+    pretrained_bart = AutoModelForSeq2SeqLM.from_pretrained('facebook/bart-base')
+    if "no-lm" in pretrained_barlow:  # no language model
+        return Twin.from_pretrained(pretrained_barlow, pretrained=pretrained_bart)
+    else:  # with language model
+        return TwinSEQ2SEQ.from_pretrained(pretrained_barlow, pretrained=pretrained_bart)
+
+
+def export_encoders(pretrained_barlow: str, directory: str, onnx: bool = False):
+    """Export the sentence and paragraph encoders of a pretrained twin model as standalone checkpoints,
+    with the tokenizer, in the subdirectories 'sentence' and 'paragraph' of a directory. LatentEmbedding
+    loads only the encoder it needs when given this directory instead of the twin model.
+    Args:
+        pretrained_barlow: The directory of the pretrained twin model.
+        directory: The directory of the exported encoders.
+        onnx: Whether to also export the encoders to ONNX, for the 'onnx' backend of LatentEmbedding.
+    """
+    tokenizer = AutoTokenizer.from_pretrained('facebook/bart-base')
+    full_twin_model = load_twin(pretrained_barlow)
+    for encoder_idx, mode in enumerate(MODES):
+        encoder = full_twin_model.encoders[encoder_idx].eval()
+        encoder.save_checkpoint(Path(directory) / mode)
+        tokenizer.save_pretrained(Path(directory) / mode)
+        if onnx:
+            encoder.export_onnx(Path(directory) / mode / LATENT_ENCODER_ONNX)
+
+
+def embedding_drift(reference: "LatentEmbedding", candidate: "LatentEmbedding", inputs: List[str]) -> Dict[str, float]:
+    """Compare the embeddings of a backend to those of a reference backend, typically 'int8' or 'onnx' against 'fp32'.
+    Args:
+        reference: The reference embedding model.
+        candidate: The embedding model to check.
+        inputs: The texts to embed.
+    Returns:
+        The mean and max cosine drift (1 - cosine similarity) of the embeddings over the inputs.
+    """
+    cosine = (reference(inputs) * candidate(inputs)).sum(-1)  # both are normalized
+    drift = 1 - cosine
+    return {"mean": drift.mean().item(), "max": drift.max().item()}
 
 
 class LatentEmbedding:
+    """Embed texts with one of the encoders of a pretrained Barlow twin model, or with a standalone encoder
+    exported by export_encoders() when pretrained_barlow is the directory of the exported encoders.
+
+    Inputs are sorted by length and encoded in micro-batches of batch_size, so that memory does not grow with
+    the number of inputs; the embeddings are returned in the original order. With dynamic_padding, each micro-batch
+    is padded to its longest input instead of to the full sequence length, which the 'mlp' latent head does not allow.
+    The encoder runs its inference path, LatentEncoder.represent(), in inference mode and without latent losses.
+
+    The backend is 'fp32', 'int8' for the encoder with its linear layers dynamically quantized to int8, or 'onnx'
+    for a standalone encoder exported to ONNX (see export_encoders()) run with ONNX Runtime; embedding_drift()
+    measures how far the embeddings of a backend are from 'fp32'.
 
-    def __init__(self, pretrained_barlow: str = PRETRAINED_BARLOW, mode: str = 'paragraph'):
+    Attributes:
+        batch_size: The number of inputs encoded together.
+        dynamic_padding: Whether micro-batches are padded to their longest input.
+        backend: The backend that runs the encoder.
+    """
+
+    def __init__(
+            self,
+            pretrained_barlow: str = PRETRAINED_BARLOW,
+            mode: str = 'paragraph',
+            batch_size: int = config.barlow_batch_size,
+            dynamic_padding: bool = config.barlow_dynamic_padding,
+            num_threads: int = config.barlow_num_threads,
+            backend: str = BARLOW_BACKEND
+        ):
         super().__init__()
-        self.tokenizer = AutoTokenizer.from_pretrained('facebook/bart-base')
-        pretrained_bart = AutoModelForSeq2SeqLM.from_pretrained('facebook/bart-base')
-        if "no-lm" in pretrained_barlow:  # no language model
-            full_twin_model = Twin.from_pretrained(pretrained_barlow, pretrained=pretrained_bart)
-        else:  # with language model
-            full_twin_model = TwinSEQ2SEQ.from_pretrained(pretrained_barlow, pretrained=pretrained_bart)
-        encoder_idx = 0 if mode == 'sentence' else 1
-        self.encoder: LatentEncoder = full_twin_model.encoders[encoder_idx]
-        self.encoder.eval()
-        # freeze the parameters
-        for p in self.encoder.parameters():
-            p.requires_grad = False
-        self.seq_len = full_twin_model.config.seq_length
+        if num_threads:
+            torch.set_num_threads(num_threads)  # process-wide setting of torch
+        self.backend = backend
+        self.encoder = None
+        checkpoint = Path(pretrained_barlow) / mode
+        if backend == 'onnx':
+            if not (checkpoint / LATENT_ENCODER_ONNX).exists():
+                raise ValueError(f"the onnx backend needs encoders exported with export_encoders(onnx=True), not found in {checkpoint}")
+            import onnxruntime  # optional dependency, only needed for this backend
+            options = onnxruntime.SessionOptions()
+            if num_threads:
+                options.intra_op_num_threads = num_threads
+            self.session = onnxruntime.InferenceSession(str(checkpoint / LATENT_ENCODER_ONNX), options, providers=["CPUExecutionProvider"])
+            self.tokenizer = AutoTokenizer.from_pretrained(checkpoint)
+            latent_config = LatentConfig.from_pretrained(checkpoint)
+            self.seq_len, self.latent_type = latent_config.seq_length, latent_config.latent_type
+        elif backend in ['fp32', 'int8']:
+            if (checkpoint / LATENT_ENCODER_WEIGHTS).exists():  # standalone encoder exported with export_encoders()
+                self.tokenizer = AutoTokenizer.from_pretrained(checkpoint)
+                self.encoder: LatentEncoder = LatentEncoder.from_checkpoint(checkpoint)
+            else:
+                self.tokenizer = AutoTokenizer.from_pretrained('facebook/bart-base')
+                full_twin_model = load_twin(pretrained_barlow)
+                encoder_idx = 0 if mode == 'sentence' else 1
+                self.encoder: LatentEncoder = full_twin_model.encoders[encoder_idx]
+            self.encoder.eval()
+            # freeze the parameters
+            for p in self.encoder.parameters():
+                p.requires_grad = False
+            if backend == 'int8':
+                self.encoder = torch.quantization.quantize_dynamic(self.encoder, {nn.Linear}, dtype=torch.qint8)
+            self.seq_len, self.latent_type = self.encoder.seq_length, self.encoder.latent_type
+        else:
+            raise ValueError(f"unknown backend {backend}")
+        self.batch_size = batch_size
+        self.dynamic_padding = dynamic_padding and self.latent_type == 'mean'
+
+    def represent(self, batch: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """The representation of a padded batch of tokenized inputs by the backend."""
+        if self.backend == 'onnx':
+            input_names = [i.name for i in self.session.get_inputs()]  # unused inputs are dropped by the export
+            (representation,) = self.session.run(None, {name: batch[name].numpy() for name in input_names})
+            return torch.from_numpy(representation)
+        return self.encoder.represent(**batch)
 
     def __call__(self, inputs: List[str]) -> torch.Tensor:
-        # test if string and make a list if so
-        tokenized = self.tokenizer(
-            inputs,
-            return_tensors="pt",
-            padding="max_length",
-            max_length=self.seq_len,
-            truncation=True
-        )
-        input_ids = tokenized['input_ids']
-        outputs = self.encoder(**tokenized)
-        representation = outputs.representation
+        tokenized = self.tokenizer(inputs, max_length=self.seq_len, truncation=True)
+        features = [
+            {"input_ids": input_ids, "attention_mask": attention_mask}
+            for input_ids, attention_mask in zip(tokenized['input_ids'], tokenized['attention_mask'])
+        ]
+        # similar lengths end up in the same micro-batch, which keeps dynamic padding short
+        order = sorted(range(len(features)), key=lambda i: len(features[i]["input_ids"]))
+        representations = []
+        for start in range(0, len(order), self.batch_size):
+            batch = [features[i] for i in order[start:start + self.batch_size]]
+            if self.dynamic_padding:
+                # round up to a multiple of 8 so that micro-batches share a few padded shapes
+                longest = len(batch[-1]["input_ids"])
+                length = min(self.seq_len, -(-longest // 8) * 8)
+            else:
+                length = self.seq_len
+            batch = self.tokenizer.pad(batch, padding="max_length", max_length=length, return_tensors="pt")
+            representations.append(self.represent(batch))
+        representation = torch.cat(representations)
+        # restore the order of the inputs
+        representation = representation[torch.tensor(order).argsort()]
         representation = torch.nn.functional.normalize(representation)
         return representation
 
 
 class LatentSentenceEmbedding(LatentEmbedding):
-    def __init__(self, pretrained: str = PRETRAINED_BARLOW):
-        super().__init__(pretrained, mode='sentence')
+    def __init__(self, pretrained: str = PRETRAINED_BARLOW, **kwargs):
+        super().__init__(pretrained, mode='sentence', **kwargs)
 
 
 class LatentParagraphEmbedding(LatentEmbedding):
-    def __init__(self, pretrained: str =PRETRAINED_BARLOW):
-        super().__init__(pretrained, mode='paragraph')
+    def __init__(self, pretrained: str =PRETRAINED_BARLOW, **kwargs):
+        super().__init__(pretrained, mode='paragraph', **kwargs)
@@ -1,5 +1,6 @@
 from dataclasses import dataclass
-from typing import List, Dict, Union, Any
+from typing import List, Dict, Union, Any, Tuple
+from pathlib import Path
 import torch
 from torch import nn
 from transformers import (
@@ -187,8 +188,16 @@ class TwinLMOutput(ModelOutput):
 
 
 
+LATENT_ENCODER_WEIGHTS = "latent_encoder.bin"
+PRETRAINED_ENCODER_CONFIG = "pretrained_encoder_config.json"
+
+
 class LatentEncoder(BartEncoder):
 
+    # modules with the weights used by forward(): the pretrained encoder and the latent head;
+    # the modules inherited from BartEncoder are not used
+    checkpoint_modules = ["model", "fc_compress", "norm_compress", "fc_z_1", "fc_z_mean", "fc_z_logvar", "norm_z"]
+
     def __init__(
         self,
         pretrained_encoder,
@@ -255,14 +264,15 @@ class LatentEncoder(BartEncoder):
         if self.freeze_pretrained in ['encoder', 'both']:
             x.requires_grad_(True)
         batch_size, length, hidden_size = x.size()  # batch_size B, length L, hidden_size H_enc
-        assert length == self.seq_length, f"observed seq length {length} mismatches with config.seq_length {self.seq_length} with input_ids.size()={input_ids.size()}"
+        if self.latent_type == "mlp":  # the mlp latent head is sized for inputs padded to seq_length
+            assert length == self.seq_length, f"observed seq length {length} mismatches with config.seq_length {self.seq_length} with input_ids.size()={input_ids.size()}"
+        else:
+            assert length <= self.seq_length, f"observed seq length {length} exceeds config.seq_length {self.seq_length} with input_ids.size()={input_ids.size()}"
         assert hidden_size == self.d_encoder, f"hidden feature size of encoder output {hidden_size} is unexpected given encoder hidden feature size {self.d_encoder}"
         y = self.vae_dropout(x)
         if self.latent_type == "mlp":
             # compress
-            y = self.fc_compress(y)  # -> B x L x H (example: 32 example x 256 token x 256 hidden features)
-            y = self.norm_compress(y)
-            y = self.act_fct(y)
+            y = self._compress(y)  # -> B x L x H (example: 32 example x 256 token x 256 hidden features)
             hidden_before_latent = y  # for visualization
             y = y.view(batch_size, (self.seq_length * self.hidden_features))  # B x (L * H)  (example: 32 * 65_536)
             # latent var
@@ -300,14 +310,8 @@ class LatentEncoder(BartEncoder):
             else:
                 raise ValueError(f"unknown loss type on latent variable {self.latent_var_loss}")
         elif self.latent_type == 'mean':
-            # attention_mask dimension is batch size x seq length
-            # needs to be expaned to batch size x seq length x hidden size
-            mask_expanded = attention_mask.unsqueeze(-1).expand(-1, -1, hidden_size).float()
-            masked_y = y * mask_expanded
+            mean, masked_y = self._masked_mean(y, attention_mask)
             hidden_before_latent = masked_y  # for visualization
-            summed_y = masked_y.sum(1)  # sum along seq length
-            summed_masks = mask_expanded.sum(1)  # count non masked element along seq length
-            mean = summed_y / summed_masks
             z = self.norm_z(mean)  # batch size x hidden size
             representation = z
             loss = torch.tensor(0)
@@ -331,6 +335,119 @@ class LatentEncoder(BartEncoder):
             supp_data=supp_data,
         )
 
+    def save_checkpoint(self, directory: Path):
+        """Save the encoder on its own, without the rest of the twin model, to be loaded with from_checkpoint().
+        Args:
+            directory: The directory of the checkpoint.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        self.config.save_pretrained(directory)
+        self.model.config.to_json_file(directory / PRETRAINED_ENCODER_CONFIG)
+        state_dict = {k: v for k, v in self.state_dict().items() if k.split('.')[0] in self.checkpoint_modules}
+        torch.save(state_dict, directory / LATENT_ENCODER_WEIGHTS)
+
+    @classmethod
+    def from_checkpoint(cls, directory: Path) -> "LatentEncoder":
+        """Load an encoder saved with save_checkpoint(), in eval mode.
+        Args:
+            directory: The directory of the checkpoint.
+        Returns:
+            The encoder.
+        """
+        directory = Path(directory)
+        config = LatentConfig.from_pretrained(directory)
+        pretrained_encoder = BartEncoder(BartConfig.from_json_file(directory / PRETRAINED_ENCODER_CONFIG))
+        # the modules of the encoder itself are built on the meta device, without memory: the unused modules
+        # inherited from BartEncoder are dropped and the latent head is materialized from the checkpoint
+        with torch.device("meta"):
+            encoder = cls(pretrained_encoder, config)
+        for name, module in list(encoder.named_children()):
+            if name not in cls.checkpoint_modules and any(p.is_meta for p in module.parameters()):
+                setattr(encoder, name, None)
+        state_dict = torch.load(directory / LATENT_ENCODER_WEIGHTS, map_location="cpu")
+        missing, unexpected = encoder.load_state_dict(state_dict, strict=False, assign=True)
+        missing = [k for k in missing if k.split('.')[0] in cls.checkpoint_modules]
+        if missing or unexpected:
+            raise ValueError(f"checkpoint in {directory} does not match the encoder: missing {missing}, unexpected {unexpected}")
+        encoder.eval()
+        return encoder
+
+    def represent(self, input_ids=None, attention_mask=None, **kwargs) -> torch.Tensor:
+        """Inference path of forward(): compute only the representation, without dropout, latent losses, sampling
+        or autograd bookkeeping.
+        Returns:
+            The representation, batch size x z_dim.
+        """
+        with torch.inference_mode():
+            return self._represent(input_ids, attention_mask, **kwargs)
+
+    def export_onnx(self, path: Path, opset_version: int = 14):
+        """Export the inference path of the encoder to ONNX.
+        Args:
+            path: The path of the ONNX file.
+            opset_version: The ONNX opset.
+        """
+        dummy_input_ids = torch.full((1, self.seq_length), self.pad_token_id, dtype=torch.long)
+        dummy_attention_mask = torch.ones((1, self.seq_length), dtype=torch.long)
+        # the mlp latent head needs inputs padded to seq_length, the mean can take any length
+        dynamic_axes = {0: "batch"} if self.latent_type == "mlp" else {0: "batch", 1: "sequence"}
+        with torch.no_grad():
+            torch.onnx.export(
+                _Representation(self),
+                (dummy_input_ids, dummy_attention_mask),
+                str(path),
+                input_names=["input_ids", "attention_mask"],
+                output_names=["representation"],
+                dynamic_axes={"input_ids": dynamic_axes, "attention_mask": dynamic_axes, "representation": {0: "batch"}},
+                opset_version=opset_version,
+            )
+
+    def _represent(self, input_ids=None, attention_mask=None, **kwargs) -> torch.Tensor:
+        x = self.model(input_ids=input_ids, attention_mask=None, **kwargs).last_hidden_state  # -> B x L x H_enc
+        batch_size, length, _ = x.size()
+        if self.latent_type == "mlp":
+            assert length == self.seq_length, f"observed seq length {length} mismatches with config.seq_length {self.seq_length} with input_ids.size()={input_ids.size()}"
+            y = self._compress(x).view(batch_size, (self.seq_length * self.hidden_features))  # B x (L * H)
+            if self.latent_var_loss in ["mmd", None]:
+                return self.norm_z(self.fc_z_1(y))
+            elif self.latent_var_loss in ["kl", "kl-mc"]:
+                return self.norm_z(self.fc_z_mean(y))  # latent before sampling, as in forward()
+            else:
+                raise ValueError(f"unknown loss type on latent variable {self.latent_var_loss}")
+        elif self.latent_type == 'mean':
+            assert length <= self.seq_length, f"observed seq length {length} exceeds config.seq_length {self.seq_length} with input_ids.size()={input_ids.size()}"
+            mean, _ = self._masked_mean(x, attention_mask)
+            return self.norm_z(mean)
+        else:
+            raise ValueError(f"unkonwn latent type {self.latent_type}")
+
+    def _compress(self, y: torch.Tensor) -> torch.Tensor:
+        y = self.fc_compress(y)  # -> B x L x H
+        y = self.norm_compress(y)
+        return self.act_fct(y)
+
+    @staticmethod
+    def _masked_mean(y: torch.Tensor, attention_mask: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        # attention_mask dimension is batch size x seq length
+        # needs to be expaned to batch size x seq length x hidden size
+        mask_expanded = attention_mask.unsqueeze(-1).expand(-1, -1, y.size(-1)).float()
+        masked_y = y * mask_expanded
+        summed_y = masked_y.sum(1)  # sum along seq length
+        summed_masks = mask_expanded.sum(1)  # count non masked element along seq length
+        return summed_y / summed_masks, masked_y
+
+
+class _Representation(nn.Module):
+    """The inference path of a LatentEncoder as the forward() of a module, for tracing."""
+
+    def __init__(self, encoder: LatentEncoder):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self, input_ids, attention_mask):
+        return self.encoder._represent(input_ids, attention_mask)
+
 
 class LatentDecoder(BartDecoder):
 
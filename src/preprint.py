@@ -1,20 +1,85 @@
 from dataclasses import dataclass, field, InitVar, asdict
-from lxml.etree import XMLParser, parse, Element
-from copy import deepcopy
+from lxml.etree import XMLParser, Resolver, DTD, parse, iterparse, Element
+from functools import lru_cache
 from tenacity import retry, stop_after_attempt, wait_fixed
-import requests
 import json
 from io import StringIO
 from pathlib import Path
-from typing import List, Callable, Dict, Any, Optional, Tuple
+from typing import List, Callable, Dict, Any, Optional, Tuple, Set, Iterable, BinaryIO
+import re
 
-from .api_tools import BioRxiv
+from .api_tools import API, BioRxiv, HTTP_CACHE
 from .utils import innertext
+from .chunk_index import CHUNK_INDEX
 from .config import config
 
-# JATS XML parser
-# not sure where DTD should live...
-JATS_PARSER = XMLParser(load_dtd=True, no_network=True, recover=True) # https://lxml.de/resolvers.html
+# JATS XML parser; entities are declared by jats_doctype() so the DTD itself is never loaded
+JATS_PARSER = XMLParser(load_dtd=False, no_network=True, recover=True) # https://lxml.de/resolvers.html
+JATS_DTD = 'JATS-journalpublishing1.dtd'
+ENTITY_REF_RE = re.compile(r'&([A-Za-z_][\w.\-]*);')
+JATS_DOCTYPE = """<?xml version="1.0"?><!DOCTYPE article PUBLIC "-//NLM//DTD JATS (Z39.96) Journal Publishing DTD v1.1 20151215//EN" "JATS-journalpublishing1.dtd">"""
+
+
+class JATSDTDResolver(Resolver):
+    """Resolve the JATS DTD and its modules from a local directory, reading each file from disk only once per process.
+
+    Attributes:
+        dtd_dir: The directory with the DTD suite.
+    """
+
+    _cache: Dict[Path, bytes] = {}  # shared by all resolvers of the process
+
+    def __init__(self, dtd_dir: str = config.jats_dtd_dir):
+        super().__init__()
+        self.dtd_dir = Path(dtd_dir)
+
+    def resolve(self, system_url, public_id, context):
+        path = self.dtd_dir / Path(system_url).name
+        content = self._cache.get(path)
+        if content is None:
+            if not path.exists():
+                return None
+            content = path.read_bytes()
+            self._cache[path] = content
+        # the base url lets libxml2 resolve the modules referenced by the DTD through this resolver too
+        return self.resolve_string(content, context, base_url=str(path))
+
+
+@lru_cache(maxsize=None)
+def jats_entity_declarations(dtd_dir: str) -> Dict[str, str]:
+    """Parse the JATS DTD suite once per process and return the declaration of each of its entities by name."""
+    dtd = DTD(str(Path(dtd_dir) / JATS_DTD))
+    declarations = {}
+    for entity in dtd.iterentities():
+        if entity.orig is not None:
+            quote = "'" if '"' in entity.orig else '"'
+            declarations[entity.name] = f'<!ENTITY {entity.name} {quote}{entity.orig}{quote}>'
+    return declarations
+
+
+def jats_doctype(xml_string: str, dtd_dir: str = config.jats_dtd_dir) -> str:
+    """Return the DOCTYPE to prepend to a JATS XML document.
+
+    Instead of loading the whole DTD suite for every document, the DOCTYPE declares in its internal subset
+    only the entities that the document references, taken from the DTD suite parsed once per process.
+    Without dtd_dir no entity is declared and named entities are dropped by the parser.
+    """
+    if not dtd_dir:
+        return JATS_DOCTYPE
+    declarations = jats_entity_declarations(dtd_dir)
+    names = set(ENTITY_REF_RE.findall(xml_string))
+    # include the entities referenced by the replacement text of the entities used
+    pending = list(names)
+    while pending:
+        declaration = declarations.get(pending.pop())
+        for name in ENTITY_REF_RE.findall(declaration or ''):
+            if name not in names:
+                names.add(name)
+                pending.append(name)
+    subset = ''.join(declarations[name] for name in sorted(names) if name in declarations)
+    return f'<?xml version="1.0"?><!DOCTYPE article [{subset}]>'
+
+
 
 """
 {
@@ -36,6 +101,275 @@ JATS_PARSER = XMLParser(load_dtd=True, no_network=True, recover=True) # https://
 """
 
 
+class JATSSectionExtractor:
+    """Extract all the sections of a preprint from its JATS XML without repeated XPath scans of the whole document.
+
+    Section titles are classified once, and the paragraphs, headings and captions are then collected
+    from the matching subtrees only; figures are skipped in place rather than removed from a copy.
+    The output is the same as the XPath queries below, applied one by one to the whole document:
+
+        introduction:    //sec/title[re:match(text(), "^introduction", "i")]/..//p
+        results:         //sec/title[re:match(text(), "^result", "i")]/..//p  (with all //fig removed)
+        result_headings: //sec/title[re:match(text(), "^result", "i")]/../sec/title
+        figures:         //fig/caption  (newlines replaced by spaces, empty captions dropped)
+        fig_titles:      //fig/caption/title
+        methods:         //sec/title[re:match(text(), "methods", "i")]/..//p
+        discussion:      //sec/title[re:match(text(), "^discussion", "i")]/..//p
+    """
+
+    # Results, Results and Discussion; discussion has to start with discussion to disambiguate from "Results and Discussion" combined section
+    SECTION_TITLES = {
+        "introduction": re.compile(r"^introduction", re.IGNORECASE),
+        "results": re.compile(r"^result", re.IGNORECASE),
+        "methods": re.compile(r"methods", re.IGNORECASE),
+        "discussion": re.compile(r"^discussion", re.IGNORECASE),
+    }
+
+    def extract(self, xml: Element) -> Dict[str, str]:
+        """Extract the sections from a parsed JATS XML tree.
+        Args:
+            xml: The root of the tree.
+        Returns:
+            The text of each section, paragraphs joined by double newlines.
+        """
+        titles = list(xml.iter('title'))  # in document order
+        matched_secs: Dict[str, List[Element]] = {section: [] for section in self.SECTION_TITLES}
+        for title in titles:
+            sec = title.getparent()
+            if sec is not None and sec.tag == 'sec':
+                first_text = _first_text_node(title)
+                for section, pattern in self.SECTION_TITLES.items():
+                    if pattern.search(first_text):
+                        matched_secs[section].append(sec)
+
+        results_secs = set(matched_secs['results'])
+        result_headings = [
+            innertext(title) for title in titles
+            if _parent_tag(title) == 'sec' and title.getparent().getparent() in results_secs
+        ]
+        fig_titles = [
+            innertext(title) for title in titles
+            if _parent_tag(title) == 'caption' and _parent_tag(title.getparent()) == 'fig'
+        ]
+        figures = []
+        for caption in xml.iter('caption'):
+            if _parent_tag(caption) == 'fig':
+                text = innertext(caption)
+                if text:
+                    figures.append(text.replace('\n', ' '))
+
+        return {
+            "introduction": self._join(self._paragraphs(matched_secs['introduction'])),
+            "results": self._join(self._paragraphs(matched_secs['results'], skip_figures=True)),
+            "result_headings": self._join(result_headings),
+            "figures": self._join(figures),
+            "fig_titles": self._join(fig_titles),
+            "methods": self._join(self._paragraphs(matched_secs['methods'])),
+            "discussion": self._join(self._paragraphs(matched_secs['discussion'])),
+        }
+
+    @staticmethod
+    def _paragraphs(secs: List[Element], skip_figures: bool = False) -> List[str]:
+        """Extract the text of all the paragraphs of a list of sec elements, each paragraph once and in document order."""
+        sec_set = set(secs)
+        paragraphs = []
+        for sec in dict.fromkeys(secs):
+            # nested sections are already covered by their outermost matching section
+            if any(ancestor in sec_set for ancestor in sec.iterancestors('sec')):
+                continue
+            if not skip_figures:
+                paragraphs.extend(innertext(p) for p in sec.iter('p'))
+                continue
+            if next(sec.iterancestors('fig'), None) is not None:
+                continue
+            in_figure, around_figure = set(), set()
+            for fig in sec.iter('fig'):
+                in_figure.update(fig.iter('p'))
+                around_figure.update(fig.iterancestors('p'))
+            for p in sec.iter('p'):
+                if p in in_figure:
+                    continue
+                paragraphs.append(innertext_without(p, 'fig') if p in around_figure else innertext(p))
+        return paragraphs
+
+    @staticmethod
+    def _join(texts: List[str]) -> str:
+        return '\n\n'.join(texts)
+
+
+class StreamingJATSSectionExtractor:
+    """Extract the sections of a preprint from its JATS XML while it is being parsed incrementally.
+
+    The extractor is driven by the start and end events of the elements: the text of paragraphs,
+    headings and captions is collected as soon as they close, and processed subtrees are freed,
+    so that peak memory does not grow with the size of the document. The output is the same as
+    JATSSectionExtractor.extract(), provided that the title of each sec comes before its paragraphs
+    and subsections, as required by the JATS DTD.
+    """
+
+    SECTION_TITLES = JATSSectionExtractor.SECTION_TITLES
+    SECTIONS = ["introduction", "results", "result_headings", "figures", "fig_titles", "methods", "discussion"]
+
+    def __init__(self, dtd_dir: str = config.jats_dtd_dir):
+        self.dtd_dir = dtd_dir  # DTD suite used to resolve entities; no DTD is loaded if empty
+        self.texts: Dict[str, List[Optional[str]]] = {section: [] for section in self.SECTIONS}
+        self._sec_stack: List[Tuple[Element, Set[str]]] = []  # open sec elements and the sections their own title matched
+        self._pending: Dict[Element, List[Tuple[str, int]]] = {}  # open elements and the slots their text goes to
+        self._fig_depth = 0
+        self._active: Tuple[str, ...] = ()  # sections the paragraphs currently open belong to
+
+    def extract(self, source: BinaryIO) -> Dict[str, str]:
+        """Extract the sections from a JATS XML byte stream, freeing each subtree once it is processed.
+        Args:
+            source: A binary file-like object with the XML.
+        Returns:
+            The text of each section, paragraphs joined by double newlines.
+        """
+        # without a DTD, named entities are undeclared and dropped, as by JATS_PARSER
+        events = iterparse(source, events=('start', 'end'), load_dtd=bool(self.dtd_dir), no_network=True, recover=True)
+        if self.dtd_dir:
+            events.resolvers.add(JATSDTDResolver(self.dtd_dir))
+        for event, el in events:
+            if event == 'start':
+                self.start(el)
+            else:
+                self.end(el)
+                # nothing outside of the open elements waiting for their text is needed anymore
+                if not self._pending:
+                    el.clear(keep_tail=True)
+                    while el.getprevious() is not None:
+                        del el.getparent()[0]
+        return self.sections()
+
+    def start(self, el: Element):
+        tag = el.tag
+        if tag == 'p':
+            # reserve the slots now to keep document order for nested paragraphs
+            if self._fig_depth:
+                # figures are removed from the results section
+                self._reserve(el, [section for section in self._active if section != 'results'])
+            else:
+                self._reserve(el, self._active)
+        elif tag == 'sec':
+            self._sec_stack.append((el, set()))
+        elif tag == 'fig':
+            self._fig_depth += 1
+        elif tag == 'caption' and _parent_tag(el) == 'fig':
+            self._reserve(el, ['figures'])
+        elif tag == 'title':
+            parent = el.getparent()
+            if parent is None:
+                return
+            if parent.tag == 'caption' and _parent_tag(parent) == 'fig':
+                self._reserve(el, ['fig_titles'])
+            # headings of the subsections of a results section
+            elif (
+                parent.tag == 'sec' and len(self._sec_stack) >= 2
+                and 'results' in self._sec_stack[-2][1] and parent.getparent() is self._sec_stack[-2][0]
+            ):
+                self._reserve(el, ['result_headings'])
+
+    def end(self, el: Element):
+        tag = el.tag
+        if tag == 'title':
+            self._classify_sec(el)
+        elif tag == 'sec':
+            _, matched = self._sec_stack.pop()
+            if matched:
+                self._update_active()
+        elif tag == 'fig':
+            self._fig_depth -= 1
+        slots = self._pending.pop(el, None)
+        if slots:
+            for section, i in slots:
+                if section == 'results':
+                    text = innertext_without(el, 'fig')
+                elif section == 'figures':
+                    text = innertext(el).replace('\n', ' ')
+                else:
+                    text = innertext(el)
+                self.texts[section][i] = text
+
+    def sections(self) -> Dict[str, str]:
+        """Return the text of each section extracted so far."""
+        return {
+            section: '\n\n'.join(text for text in texts if text is not None and (text or section != 'figures'))
+            for section, texts in self.texts.items()
+        }
+
+    def _classify_sec(self, title: Element):
+        parent = title.getparent()
+        if parent is None:
+            return
+        if parent.tag == 'sec' and self._sec_stack and self._sec_stack[-1][0] is parent:
+            first_text = _first_text_node(title)
+            matched = self._sec_stack[-1][1]
+            for section, pattern in self.SECTION_TITLES.items():
+                if pattern.search(first_text):
+                    matched.add(section)
+            self._update_active()
+
+    def _update_active(self):
+        self._active = tuple(sorted(set().union(*[matched for _, matched in self._sec_stack])))
+
+    def _reserve(self, el: Element, sections: Iterable[str]):
+        if sections:
+            slots = []
+            for section in sections:
+                slots.append((section, len(self.texts[section])))
+                self.texts[section].append(None)
+            self._pending[el] = slots
+
+
+class PrefixedStream:
+    """A binary file-like object that reads a prefix and then the content of another stream."""
+    def __init__(self, prefix: bytes, stream: BinaryIO):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, size: int = -1) -> bytes:
+        if not self.prefix:
+            return self.stream.read(size)
+        if size is None or size < 0:
+            data, self.prefix = self.prefix + self.stream.read(), b''
+            return data
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        return data
+
+
+def _parent_tag(el: Element) -> Optional[str]:
+    parent = el.getparent()
+    return parent.tag if parent is not None else None
+
+
+def _first_text_node(el: Element) -> str:
+    """Return the first text node child of an element, as selected by text() in XPath."""
+    if el.text:
+        return el.text
+    for child in el:
+        if child.tail:
+            return child.tail
+    return ''
+
+
+def innertext_without(el: Element, tag: str) -> str:
+    """Extract the inner text from an XML element as if all its descendants with a given tag had been removed, including their tail."""
+    parts = []
+
+    def walk(node: Element):
+        if isinstance(node.tag, str) and node.text:
+            parts.append(node.text)
+        for child in node:
+            if child.tag == tag:
+                continue
+            walk(child)
+            if child.tail:
+                parts.append(child.tail)
+
+    walk(el)
+    return ''.join(parts)
+
+
 @dataclass
 class BioRxivMetadata:
     """extract the biorxiv metadata from the API response"""
@@ -85,12 +419,15 @@ class Preprint:
         sections: The sections of the preprint.
     """
 
-    def __init__(self, doi: Optional[str] = None):
+    def __init__(self, doi: Optional[str] = None, streaming: bool = False):
         """Initialize the Preprint object.
+        Args:
+            doi: The DOI of the preprint.
+            streaming: Whether to parse the JATS XML incrementally, to bound memory on very large documents.
         """
         self.doi = doi
         if doi is not None:
-            self.biorxiv_meta, self.sections = self._from_biorxiv_api(doi)
+            self.biorxiv_meta, self.sections = self._from_biorxiv_api(doi, streaming)
         else:
             self.biorxiv_meta = None
             self.sections = {
@@ -104,24 +441,20 @@ class Preprint:
             }
 
 
-    def _from_biorxiv_api(self, doi: str) -> Tuple[BioRxivMetadata, Dict[str, str]]:
+    def _from_biorxiv_api(self, doi: str, streaming: bool = False) -> Tuple[BioRxivMetadata, Dict[str, str]]:
         """Initialize the Preprint object from the bioRxiv API.
         Args:
             doi: The DOI of the preprint.
+            streaming: Whether to parse the JATS XML incrementally.
         """
         response = BioRxiv().get_preprint(doi)
         biorxiv_meta = BioRxivMetadata(data=response)
         xml_source = response['jatsxml']  # nice! For ex jatsxml: "https://www.biorxiv.org/content/early/2018/06/05/339747.source.xml"
-        xml = self.get_jatsxml(xml_source)
-        sections = {
-            "introduction": self._introduction(xml),
-            "results": self._results(xml),
-            "result_headings": self._result_headings(xml),
-            "figures": self._figures(xml),
-            "fig_titles": self._fig_titles(xml),
-            "methods": self._methods(xml),
-            "discussion": self._discussion(xml)
-        }
+        if streaming:
+            sections = self.stream_sections(xml_source)
+        else:
+            xml = self.get_jatsxml(xml_source)
+            sections = JATSSectionExtractor().extract(xml)
         return biorxiv_meta, sections
 
     def save(self, dir: Path):
@@ -186,73 +519,20 @@ class Preprint:
     def get_jatsxml(self, url: str) -> Element:
         """Return the JATS XML of the preprint."""
         headers = {'Accept': 'application/xml'}
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        xml_string = response.text
-        xml_def = """<?xml version="1.0"?><!DOCTYPE article PUBLIC "-///NLM//DTD JATS (Z39.96) Journal Publishing DTD v1.1 20151215//EN" "JATS-journalpublishing1-3.dtd">"""
-        xml_string = xml_def + xml_string
+        xml_string = HTTP_CACHE.get(API.session, url, headers=headers)
+        xml_string = jats_doctype(xml_string) + xml_string
         xml = parse(StringIO(xml_string), JATS_PARSER)
         root = xml.getroot()
         return root
 
-    def _introduction(self, xml: Element) -> str:
-        """Extract the introduction section of the preprint using the JATS XML and the appropriate XPath."""
-        return self._extract_section('//sec/title[re:match(text(), "^introduction", "i")]/..//p', xml)
-
-    def _results(self, xml: Element) -> str:
-        """Extract the results section of the preprint using the JATS XML and the appropriate XPath."""
-        # Results, Results and Discussion
-        return self._extract_section('//sec/title[re:match(text(), "^result", "i")]/..//p', xml, internal_element_to_remove='//fig')
+    @retry(stop=stop_after_attempt(3), wait=wait_fixed(1))
+    def stream_sections(self, url: str) -> Dict[str, str]:
+        """Extract the sections of the preprint while its JATS XML is being read, without holding the whole document in memory."""
+        headers = {'Accept': 'application/xml'}
+        with HTTP_CACHE.stream(API.session, url, headers=headers) as body:
+            source = PrefixedStream(JATS_DOCTYPE.encode('utf-8'), body)
+            return StreamingJATSSectionExtractor().extract(source)
 
-    def _result_headings(self, xml: Element) -> str:
-        """Extract the results headings section of the preprint using the JATS XML and the appropriate XPath."""
-        # Results, Results and Discussion
-        return self._extract_section('//sec/title[re:match(text(), "^result", "i")]/../sec/title', xml)
-    
-    def _figures(self, xml: Element) -> str:
-        """Extract the figures section of the preprint using the JATS XML and the appropriate XPath."""
-        return self._extract_section('//fig/caption', xml, remove_newlines_first=True)
-    
-    def _fig_titles(self, xml: Element) -> str:
-        """Extract the figure title section of the preprint using the JATS XML and the appropriate XPath."""
-        return self._extract_section('//fig/caption/title', xml)
-
-    def _methods(self, xml: Element) -> str:
-        """Extract the methods section of the preprint using the JATS XML and the appropriate XPath."""
-        return self._extract_section('//sec/title[re:match(text(), "methods", "i")]/..//p', xml)
-
-    def _discussion(self, xml:Element) -> str:
-        """Extract the discussion section of the preprint using the JATS XML and the appropriate XPath."""
-        # Has to start with discussion to disambiguate from "Results and Discussion" combined section
-        return self._extract_section('//sec/title[re:match(text(), "^discussion", "i")]/..//p', xml)
-
-    def _extract_section(self, xpath: str, xml: Element, remove_newlines_first:bool = False, internal_element_to_remove: str='') -> str:
-        """Extract a section of the preprint using the JATS XML and the appropriate XPath."""
-        if internal_element_to_remove:
-            xml = deepcopy(xml)  # don't modify the original xml
-            internal_elements = xml.xpath(internal_element_to_remove, namespaces={"re": "http://exslt.org/regular-expressions"})
-            for el in internal_elements:
-                el.getparent().remove(el)
-        elements = xml.xpath(xpath, namespaces={"re": "http://exslt.org/regular-expressions"})  # namespace prefix to enable regex usage in XPath
-        return self._extract_text(elements, remove_newlines_first)
-
-    def _extract_text(self, elements: List[Element], remove_newlines_first: bool = False) -> str:
-        """Extract the innertext from list of xml etree Elements. Paragraphs are joined with double newline.
-        Args:
-            elements: The list of etree Elements.
-            remove_newlines_first: Whether to remove newlines from the text of each element first.
-        """
-        if remove_newlines_first:
-            text_elements = []
-            for el in elements:
-                text = innertext(el)
-                if text: 
-                    text = text.replace('\n', ' ')
-                    text_elements.append(text)
-            return '\n\n'.join(text_elements)
-        else:
-            return '\n\n'.join([innertext(el) for el in elements])
-    
     def get_chunks(self, chunking_fn: Callable, sections: str = config.sections) -> List[str]:
         """Return the paragraphs of a sections of the preprint.
         Args:L
@@ -262,7 +542,8 @@ class Preprint:
             A list of chunks.
         """
         section_list = sections.split('+')
+        keys = [(self.doi, section) for section in section_list]
         chunks = []
-        for section in section_list:
-            chunks += chunking_fn(self.sections[section])
+        for section_chunks in CHUNK_INDEX.get_chunks(chunking_fn, keys, [self.sections[section] for section in section_list]):
+            chunks += section_chunks
         return chunks
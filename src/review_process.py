@@ -1,10 +1,11 @@
-from typing import List, Callable, Optional
+from typing import List, Callable, Optional, Tuple
 from dataclasses import dataclass, field, asdict
 from pathlib import Path
 import json
 
 from .api_tools import EEB
 from .utils import split_paragraphs
+from .chunk_index import CHUNK_INDEX
 
 """Classes to retrieve the peer review process including the individual referee reports linked to a preprint specified by its DOI."""
 
@@ -113,9 +114,14 @@ class Review:
     def asdict(self):
         return asdict(self)
 
+    @property
+    def chunk_key(self) -> Tuple[str, str]:
+        """The DOI of the reviewed preprint and the part of the text identifying the review in the chunk index."""
+        return self.related_article_doi, f"review:{self.hypothesis_id or self.review_idx}"
+
     def get_chunks(self, chunking_fn: Callable = split_paragraphs):
         """Get the paragraphs of the text of the review."""
-        return chunking_fn(self.text)
+        return CHUNK_INDEX.get_chunks(chunking_fn, [self.chunk_key], [self.text])[0]
 
     def save(self, dir: Path):
         # save the review to file
@@ -10,11 +10,11 @@ from .utils import stringify_doi
 
 class ReviewedPreprint: 
     """A class to represent a reviewed preprint and save it to disk"""
-    def __init__(self, doi: Optional[str] = None):
+    def __init__(self, doi: Optional[str] = None, streaming: bool = False):
         if doi is not None:
             self.doi = doi
             self.review_process = ReviewProcess(self.doi)
-            self.preprint = Preprint(self.doi)
+            self.preprint = Preprint(self.doi, streaming=streaming)
         else:
             self.doi = None
             self.review_process = None
@@ -1,8 +1,17 @@
-from random import choice, sample
-from typing import List, Callable, Dict
+import multiprocessing
+import os
+import random
+import tempfile
+from pathlib import Path
+from random import Random
+from typing import List, Callable, Dict, Optional, Tuple
+import numpy as np
+import torch
 
 from .corpus import Corpus
+from .corpus_embeddings import CorpusEmbeddings
 from .comparator import Comparator
+from .distribution import SimilarityDistribution
 from .embed import Embedder
 from .utils import split_paragraphs
 from .config import config
@@ -11,12 +20,18 @@ from .config import config
 """A module to sample an empirical null distribution of similarity scores between review and preprint."""
 
 class Sampler:
+    """Sample similarity scores between the chunks of preprints and of their own (enriched) or other (null) reviews.
+
+    All the chunks of the corpus are embedded once, on the first call to sample() unless precomputed corpus_embeddings
+    are given, so that sampling only slices the embedding matrices and multiplies them.
+    """
 
     def __init__(
             self,
             corpus: Corpus,
             embedder: List[Embedder],
-            chunking_fn: List[Callable] = [split_paragraphs, split_paragraphs]
+            chunking_fn: List[Callable] = [split_paragraphs, split_paragraphs],
+            corpus_embeddings: Optional[CorpusEmbeddings] = None
         ):
         self.corpus = corpus
         self.N = len(corpus)
@@ -26,53 +41,199 @@ class Sampler:
         if not isinstance(chunking_fn, list):
             chunking_fn = [chunking_fn, chunking_fn]
         self.chunking_fn = {"review": chunking_fn[0], "preprint": chunking_fn[1]}
+        self._corpus_embeddings = corpus_embeddings
 
-    def sample(self, n_sample: int) -> Dict[str, List[float]]:
-        assert self.N >= 2 * n_sample, f"Number of preprints ({self.N}) must be greater than twice the number of samples ({n_sample})."
-        
-        all_indices = list(range(self.N))
-
-        # indices of reviewed preprint that will be used to sample preprints
-        sampled_rev_preprint_indices = sample(all_indices, n_sample)
-
-        # similarity scores between cognate reviews and preprints      
-        sampled_preprint_chunks: List[List[str]] = []
-        sampled_cognate_review_chunks: List[List[str]] = []
-        for i in sampled_rev_preprint_indices:
-            rev_preprint = self.corpus.reviewed_preprints[i]
-            preprint = rev_preprint.preprint
-            if preprint is not None and rev_preprint.review_process is not None:
-                sampled_preprint_chunks.append(preprint.get_chunks(self.chunking_fn["preprint"], config.sections))
-                reviews = rev_preprint.review_process.reviews
-                review = choice(reviews)  # take one random review from the reviews of the preprint
-                sampled_cognate_review_chunks.append(review.get_chunks(self.chunking_fn["review"]))
-        similarities_enriched = self._compare(sampled_preprint_chunks, sampled_cognate_review_chunks)
-
-        # similarity scores between non-cognate reviews and preprints
-        # indices of reviewed preprint that will be used to sample non-cognate reviews;
-        # they MUST be different from the sampled reviewed preprint above, hence 'non-cognate'
-        for x in sampled_rev_preprint_indices:
-           all_indices.remove(x)
-
-        samples_non_cognate_indices = sample(all_indices, n_sample)
-        sampled_non_cognate_review_chunks: List[List[str]] = []
-        for i in samples_non_cognate_indices:
-            rev_preprint = self.corpus.reviewed_preprints[i]
-            if rev_preprint.review_process is not None:
-                reviews = rev_preprint.review_process.reviews
-                review = choice(reviews)  # take one random review from the reviews of the preprint
-                sampled_non_cognate_review_chunks.append(review.get_chunks(self.chunking_fn["review"])) 
-        similarities_null = self._compare(sampled_preprint_chunks, sampled_non_cognate_review_chunks)
+    @property
+    def corpus_embeddings(self) -> CorpusEmbeddings:
+        if self._corpus_embeddings is None:
+            self._corpus_embeddings = CorpusEmbeddings.from_corpus(
+                self.corpus,
+                preprint_embedder=self.comparator.embedder[0],
+                review_embedder=self.comparator.embedder[1],
+                preprint_chunking_fn=self.chunking_fn["preprint"],
+                review_chunking_fn=self.chunking_fn["review"],
+                sections=config.sections,
+            )
+        return self._corpus_embeddings
 
+    def sample(self, n_sample: int, seed: Optional[int] = None) -> Dict[str, np.ndarray]:
+        """Sample the similarity scores of n_sample preprints with their own reviews and with reviews of other preprints.
+        Args:
+            n_sample: The number of preprints sampled.
+            seed: The seed of the draw, for a reproducible sample; the global random state by default.
+        Returns:
+            The flattened 'null' and 'enriched' similarity scores.
+        """
+        preprints, cognate_reviews, non_cognate_reviews = _draw(self.corpus_embeddings, n_sample, _rng(seed))
         return {
-            "null": similarities_null,
-            "enriched": similarities_enriched,
+            "null": _compare(preprints, non_cognate_reviews),
+            "enriched": _compare(preprints, cognate_reviews),
         }
+
+    def accumulate(
+            self,
+            n_sample: int,
+            distributions: Optional[Dict[str, SimilarityDistribution]] = None,
+            pairs_per_batch: int = 256,
+            seed: Optional[int] = None
+        ) -> Dict[str, SimilarityDistribution]:
+        """Sample as sample(), but add the similarity scores to histogram accumulators instead of returning them,
+        so that memory does not grow with the number of scores.
+        Args:
+            n_sample: The number of preprints sampled.
+            distributions: The 'null' and 'enriched' distributions to add the scores to, for example those of a previous
+                run; new empty distributions by default.
+            pairs_per_batch: The number of pairs of preprint and review compared at once.
+            seed: The seed of the draw, for a reproducible sample; the global random state by default.
+        Returns:
+            The 'null' and 'enriched' distributions; they can be merged with those of other runs or workers.
+        """
+        return _accumulate(self.corpus_embeddings, n_sample, _rng(seed), pairs_per_batch, distributions)
+
+    def sample_parallel(
+            self,
+            n_sample: int,
+            seed: int = 0,
+            replicates: int = 1,
+            n_shards: int = 16,
+            processes: Optional[int] = None,
+            threads_per_process: int = 1,
+            pairs_per_batch: int = 256,
+            path: Optional[Path] = None
+        ) -> List[Dict[str, SimilarityDistribution]]:
+        """Sample as accumulate(), split into independently seeded shards run over a pool of worker processes.
+
+        Each replicate draws n_sample preprints in n_shards shards; the seed of each shard is derived from seed and the
+        indices of the replicate and of the shard only, and the shards are merged in order, so the result depends on
+        seed, replicates and n_shards but not on the number of processes. Within a shard, the non-cognate reviews are
+        drawn from other preprints than the sampled ones; across shards the same preprint can be drawn again.
+        Several replicates give the spread of the sampled distributions, see bootstrap_band().
+
+        The corpus embeddings are saved once to path and memory-mapped by every worker rather than copied to each.
+        Args:
+            n_sample: The number of preprints sampled in each replicate.
+            seed: The seed of the whole run.
+            replicates: The number of independent replicates.
+            n_shards: The number of shards of each replicate.
+            processes: The number of worker processes; one per CPU by default.
+            threads_per_process: The number of torch intra-op threads of each worker.
+            pairs_per_batch: The number of pairs of preprint and review compared at once.
+            path: Where to save the corpus embeddings shared with the workers; a temporary file by default.
+        Returns:
+            The 'null' and 'enriched' distributions of each replicate.
+        """
+        shard_sizes = [len(shard) for shard in np.array_split(np.arange(n_sample), n_shards) if len(shard)]
+        seeds = np.random.SeedSequence(seed).spawn(replicates)
+        tasks = [
+            (size, int(shard_seed.generate_state(1)[0]), pairs_per_batch)
+            for replicate_seed in seeds
+            for size, shard_seed in zip(shard_sizes, replicate_seed.spawn(len(shard_sizes)))
+        ]
+        processes = processes or os.cpu_count() or 1
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(path or Path(directory) / "corpus_embeddings.pt")
+            self.corpus_embeddings.save(path)
+            # spawn rather than fork: torch threads do not survive a fork
+            context = multiprocessing.get_context("spawn")
+            with context.Pool(processes, initializer=_shard_worker_init, initargs=(str(path), threads_per_process)) as pool:
+                shards = pool.map(_shard_worker_sample, tasks)
+
+        results = []
+        for replicate in range(replicates):
+            distributions = {"null": SimilarityDistribution(), "enriched": SimilarityDistribution()}
+            for shard in shards[replicate * len(shard_sizes):(replicate + 1) * len(shard_sizes)]:
+                for key, distribution in distributions.items():
+                    distribution.merge(shard[key])
+            results.append(distributions)
+        return results
+
+
+def _rng(seed: Optional[int]):
+    return random if seed is None else Random(seed)
+
+
+def _draw(
+        embeddings: CorpusEmbeddings,
+        n_sample: int,
+        rng=random
+    ) -> Tuple[List[torch.Tensor], List[torch.Tensor], List[torch.Tensor]]:
+    """Draw preprints with one of their own reviews and one review of another preprint.
+    Args:
+        embeddings: The embeddings of the corpus.
+        n_sample: The number of preprints sampled.
+        rng: The random number generator, the random module or a random.Random.
+    Returns:
+        The chunk embeddings of the sampled preprints, of their cognate reviews and of the non-cognate reviews.
+    """
+    N = len(embeddings.dois)
+    assert N >= 2 * n_sample, f"Number of preprints ({N}) must be greater than twice the number of samples ({n_sample})."
     
-    def _compare(self, chunk_list_1: List[List[str]], chunk_list_2: List[List[str]]) -> List[float]:
-        assert len(chunk_list_1) == len(chunk_list_2), "The number of examples in the two chunk lists must be the same."
-        similarities = []
-        for chunks_1, chunks_2 in zip(chunk_list_1, chunk_list_2):
-            s = self.comparator.compare_dot(chunks_1, chunks_2)
-            similarities += s.view(-1).tolist()  # flatten the similarity matrix
-        return similarities
+    all_indices = list(range(N))
+
+    # indices of reviewed preprint that will be used to sample preprints
+    sampled_rev_preprint_indices = rng.sample(all_indices, n_sample)
+
+    # cognate reviews and preprints      
+    sampled_preprint_embeddings: List[torch.Tensor] = []
+    sampled_cognate_review_embeddings: List[torch.Tensor] = []
+    for i in sampled_rev_preprint_indices:
+        doi = embeddings.dois[i]
+        reviews = embeddings.reviews(doi)
+        if embeddings.has_preprint(doi) and reviews:
+            sampled_preprint_embeddings.append(embeddings.preprint(doi, config.sections))
+            review = rng.choice(reviews)  # take one random review from the reviews of the preprint
+            sampled_cognate_review_embeddings.append(review)
+
+    # non-cognate reviews
+    # indices of reviewed preprint that will be used to sample non-cognate reviews;
+    # they MUST be different from the sampled reviewed preprint above, hence 'non-cognate'
+    for x in sampled_rev_preprint_indices:
+       all_indices.remove(x)
+
+    samples_non_cognate_indices = rng.sample(all_indices, n_sample)
+    sampled_non_cognate_review_embeddings: List[torch.Tensor] = []
+    for i in samples_non_cognate_indices:
+        reviews = embeddings.reviews(embeddings.dois[i])
+        if reviews:
+            review = rng.choice(reviews)  # take one random review from the reviews of the preprint
+            sampled_non_cognate_review_embeddings.append(review)
+    return sampled_preprint_embeddings, sampled_cognate_review_embeddings, sampled_non_cognate_review_embeddings
+
+
+def _compare(embeddings_1: List[torch.Tensor], embeddings_2: List[torch.Tensor]) -> np.ndarray:
+    assert len(embeddings_1) == len(embeddings_2), "The number of examples in the two embedding lists must be the same."
+    # the flattened similarity matrices of all the pairs, as Comparator.compare_dot() on each pair
+    similarities, _ = Comparator.block_dot(embeddings_1, embeddings_2)
+    return similarities.cpu().numpy()
+
+
+def _accumulate(
+        embeddings: CorpusEmbeddings,
+        n_sample: int,
+        rng=random,
+        pairs_per_batch: int = 256,
+        distributions: Optional[Dict[str, SimilarityDistribution]] = None
+    ) -> Dict[str, SimilarityDistribution]:
+    if distributions is None:
+        distributions = {"null": SimilarityDistribution(), "enriched": SimilarityDistribution()}
+    preprints, cognate_reviews, non_cognate_reviews = _draw(embeddings, n_sample, rng)
+    for start in range(0, len(preprints), pairs_per_batch):
+        batch = slice(start, start + pairs_per_batch)
+        distributions["enriched"].update(_compare(preprints[batch], cognate_reviews[batch]))
+        distributions["null"].update(_compare(preprints[batch], non_cognate_reviews[batch]))
+    return distributions
+
+
+# the corpus embeddings of each worker process of Sampler.sample_parallel()
+_shard_worker_embeddings: Optional[CorpusEmbeddings] = None
+
+
+def _shard_worker_init(path: str, threads: int):
+    global _shard_worker_embeddings
+    torch.set_num_threads(threads)
+    _shard_worker_embeddings = CorpusEmbeddings.load(Path(path), mmap=True)
+
+
+def _shard_worker_sample(task: Tuple[int, int, int]) -> Dict[str, SimilarityDistribution]:
+    n_sample, seed, pairs_per_batch = task
+    return _accumulate(_shard_worker_embeddings, n_sample, Random(seed), pairs_per_batch)
@@ -0,0 +1,53 @@
+from typing import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+import sqlite3
+
+
+"""The SQLite files of the package (the chunk index, the embedding cache and the corpus store), opened one transaction at a time."""
+
+
+class SQLiteFile:
+    """A SQLite file whose directory and tables are created on its first transaction.
+
+    Attributes:
+        path: The path to the SQLite file.
+        schema: The SQL script that creates the tables, with CREATE ... IF NOT EXISTS statements.
+        create: Whether to create the file if it does not exist; otherwise a missing file raises FileNotFoundError.
+        timeout: Seconds to wait for the lock of another connection.
+    """
+    def __init__(self, path: Path, schema: str = '', create: bool = True, timeout: float = 60):
+        self.path = Path(path)
+        self.schema = schema
+        self.create = create
+        self.timeout = timeout
+        self._initialized = False
+
+    def connect(self) -> sqlite3.Connection:
+        """A new connection to the file, left for the caller to close."""
+        if not self._initialized:
+            if self.create:
+                # created on first use rather than on import
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+            elif not self.path.exists():
+                raise FileNotFoundError(f"No SQLite file at {self.path}")
+        conn = sqlite3.connect(self.path, timeout=self.timeout)
+        if not self._initialized:
+            try:
+                with conn:
+                    conn.executescript(self.schema)
+            except sqlite3.Error:
+                conn.close()
+                raise
+            self._initialized = True
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """A connection for one transaction, committed, or rolled back on error, and closed on exit."""
+        conn = self.connect()
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
@@ -1,13 +1,13 @@
+from functools import lru_cache
 from lxml.etree import Element
-from typing import List
-import spacy
-import nltk
-nltk.download('punkt')
+from typing import Callable, Dict, Iterable, List, Optional, Pattern, Tuple, TYPE_CHECKING
 import re
 
-from .config import config
+if TYPE_CHECKING:
+    # spaCy and nltk take seconds to import and are only loaded on first use
+    from spacy.language import Language
 
-nlp = spacy.load("en_core_web_sm")
+from .config import config
 
 # a function to extract the inner text from the JATS XML using itertext()
 def innertext(el: Element) -> str:
@@ -46,11 +46,46 @@ BOILERPLATE = [
 ]
 
 
+@lru_cache(maxsize=None)
+def boilerplate_matcher(boilerplate: Tuple[str, ...]) -> Pattern:
+    """A single regular expression that finds any of the boilerplate strings, compiled once per list of strings.
+    Args:
+        boilerplate: The boilerplate strings, matched literally.
+    Returns:
+        The compiled regular expression.
+    """
+    # longest first so that a string is not shadowed by one of its prefixes
+    alternatives = sorted(set(boilerplate), key=len, reverse=True)
+    return re.compile('|'.join(re.escape(b) for b in alternatives))
+
+
+def filter_chunks(chunks: List[str], min_length: Optional[int] = None) -> List[str]:
+    """Remove the chunks that are too short or that contain boilerplate.
+    Args:
+        chunks: The chunks.
+        min_length: The minimum length of the chunks kept; config.min_length by default.
+    Returns:
+        The chunks kept, in order.
+    """
+    min_length = config.min_length if min_length is None else min_length
+    search = boilerplate_matcher(tuple(BOILERPLATE + config.extra_boilerplate)).search
+    return [chunk for chunk in chunks if len(chunk) >= min_length and search(chunk) is None]
+
+
+def filter_corpus_chunks(corpus_chunks: List[List[str]], min_length: Optional[int] = None) -> List[List[str]]:
+    """Remove the chunks that are too short or that contain boilerplate from the chunks of many texts at once.
+    Args:
+        corpus_chunks: The list of chunks of each text.
+        min_length: The minimum length of the chunks kept; config.min_length by default.
+    Returns:
+        The list of chunks kept of each text.
+    """
+    return [filter_chunks(chunks, min_length) for chunks in corpus_chunks]
+
+
 def filtering(docs: List[str]) -> List[str]:
-    filtered = filter(lambda p: len(p) >= config.min_length, docs)
-    filtered = filter(lambda p: not any(b in p for b in BOILERPLATE), filtered)
-    filtered = list(filtered)
-    return filtered
+    """Remove the chunks that are too short or that contain boilerplate, see filter_chunks()."""
+    return filter_chunks(docs)
 
 
 def split_paragraphs(text: str) -> List[str]:
@@ -64,10 +99,34 @@ def split_paragraphs(text: str) -> List[str]:
     text = re.sub('\n +', '\n', text)
     para = text.split('\n')
     para = [p.strip() for p in para]
-    filtered = filtering(para)
+    filtered = filter_chunks(para)
     return filtered
 
 
+# the components of en_core_web_sm left out of the pipeline of each sentence splitter:
+# 'parser' takes the sentences from the dependency parse, exactly as the full pipeline does;
+# 'senter' uses the much faster statistical sentence segmenter alone, with slightly different boundaries
+SENTENCE_PIPELINES = {
+    "parser": ["tagger", "attribute_ruler", "lemmatizer", "ner"],
+    "senter": ["tok2vec", "tagger", "parser", "attribute_ruler", "lemmatizer", "ner"],
+}
+
+
+@lru_cache(maxsize=None)
+def sentence_nlp(components: str) -> "Language":
+    """The spaCy pipeline trimmed to the components that set sentence boundaries.
+    Args:
+        components: The sentence splitter, 'parser' or 'senter' (see SENTENCE_PIPELINES).
+    Returns:
+        The pipeline, loaded once per splitter.
+    """
+    import spacy
+    pipeline = spacy.load("en_core_web_sm", exclude=SENTENCE_PIPELINES[components])
+    if components == "senter":
+        pipeline.enable_pipe("senter")
+    return pipeline
+
+
 def split_sentences(text: str) -> List[str]:
     """Split text into sentences.
     Args:   
@@ -75,10 +134,36 @@ def split_sentences(text: str) -> List[str]:
     Returns:
         A list of sentences.
     """
-    doc = nlp(text)
-    sentences = [sent.text for sent in doc.sents]
-    filtered = filtering(sentences)
-    return filtered
+    return split_sentences_batch([text])[0]
+
+
+def split_sentences_batch(texts: Iterable[str], batch_size: Optional[int] = None, n_process: Optional[int] = None) -> List[List[str]]:
+    """Split many texts into sentences at once, streaming them through the spaCy pipeline in batches.
+    Args:
+        texts: The texts to split into sentences.
+        batch_size: The number of texts processed together; config.sentence_splitter['batch_size'] by default.
+        n_process: The number of processes of the pipeline; config.sentence_splitter['n_process'] by default.
+    Returns:
+        The list of sentences of each text, as split_sentences() would return it.
+    """
+    pipeline = sentence_nlp(config.sentence_splitter["components"])
+    docs = pipeline.pipe(
+        texts,
+        batch_size=batch_size or config.sentence_splitter["batch_size"],
+        n_process=n_process or config.sentence_splitter["n_process"],
+    )
+    return filter_corpus_chunks([[sent.text for sent in doc.sents] for doc in docs])
+
+
+@lru_cache(maxsize=None)
+def punkt():
+    """The nltk module, with the punkt sentence tokenizer downloaded the first time it is needed."""
+    import nltk
+    try:
+        nltk.data.find('tokenizers/punkt')
+    except LookupError:
+        nltk.download('punkt')
+    return nltk
 
 
 def split_sentences_nltk(text: str) -> List[str]:
@@ -88,9 +173,32 @@ def split_sentences_nltk(text: str) -> List[str]:
     Returns:
         A list of sentences.
     """
-    sentences = nltk.sent_tokenize(text)
-    filtered = filtering(sentences)
+    sentences = punkt().sent_tokenize(text)
+    filtered = filter_chunks(sentences)
     return filtered
 
 
+# the version of the chunking functions; to be increased when they change, so that chunks indexed before are recomputed
+CHUNKING_VERSION = 1
+
+# chunking functions that have a faster version for many texts at once
+BATCH_CHUNKING_FNS: Dict[Callable[[str], List[str]], Callable[[List[str]], List[List[str]]]] = {
+    split_sentences: split_sentences_batch,
+}
+
+
+def chunk_texts(chunking_fn: Callable[[str], List[str]], texts: List[str]) -> List[List[str]]:
+    """Chunk many texts at once, with the batch version of the chunking function if it has one.
+    Args:
+        chunking_fn: The function to chunk a text, for example split_paragraphs or split_sentences.
+        texts: The texts to chunk.
+    Returns:
+        The list of chunks of each text, as chunking_fn would return it.
+    """
+    batch_fn = BATCH_CHUNKING_FNS.get(chunking_fn)
+    if batch_fn is not None:
+        return batch_fn(texts)
+    return [chunking_fn(text) for text in texts]
+
+
 doi_str_re = re.compile(r'^10_\d{4,9}-[-._;()/:A-Z0-9]+$', re.IGNORECASE)
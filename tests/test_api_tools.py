@@ -0,0 +1,103 @@
+import unittest
+import json
+from pathlib import Path
+from shutil import rmtree
+from tempfile import TemporaryDirectory
+from unittest import mock
+import requests
+
+from src.api_tools import API, EEB, HTTPCache, pooled_session
+
+# Test case for testing the cache of the API clients
+
+
+class TestHTTPCache(unittest.TestCase):
+    # setup class method
+    @classmethod
+    def setUpClass(cls):
+        cls.basedir = Path("/tmp/test_http_cache")
+        print(f"Creating {cls.basedir} ...")
+        cls.basedir.mkdir(parents=True, exist_ok=True)
+        cls.url = 'https://api.biorxiv.org/details/biorxiv/10.1101/2021.05.12.443743'
+
+    @classmethod
+    def tearDownClass(cls):
+        # delete the directories created
+        print(f"Cleaning up {cls.basedir} ...")
+        rmtree(cls.basedir)
+
+    def test_cache(self):
+        cache = HTTPCache(self.basedir, ttl=3600, max_size=10 * 1024 ** 2)
+        fetched = cache.get(API.session, self.url)
+        self.assertEqual(len(list(self.basedir.glob('*/*.body'))), 1)
+        self.assertEqual(cache.get(API.session, self.url), fetched)
+        # expired entries are revalidated and still served
+        cache.ttl = 0
+        self.assertEqual(cache.get(API.session, self.url), fetched)
+        # entries beyond max_size are evicted
+        cache.max_size = 1
+        cache.get(API.session, self.url.replace('443743', '443744'))
+        self.assertEqual(len(list(self.basedir.glob('*/*.body'))), 0)
+
+
+def response(url: str, status_code: int, body) -> requests.Response:
+    r = requests.Response()
+    r.url, r.status_code, r.encoding = url, status_code, 'utf-8'
+    r._content, r._content_consumed = json.dumps(body).encode('utf-8'), True
+    return r
+
+
+class StubSession:
+    """A session answering the EEB API from a dict of DOI to referee reports, counting the requests sent."""
+
+    def __init__(self, reports):
+        self.reports = reports
+        self.sent = []
+
+    def get(self, url, headers=None, stream=False):
+        self.sent.append(url)
+        doi = url.split('/doi/')[-1]
+        return response(url, 200, [self.reports[doi]] if doi in self.reports else [])
+
+
+class TestAPIClients(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.reports = {f'10.1101/2020.01.01.00000{i}': {'doi': f'10.1101/2020.01.01.00000{i}'} for i in range(5)}
+        self.session = StubSession(self.reports)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_get_many(self):
+        dois = list(self.reports) + ['10.1101/0000.00.00.000000']
+        with mock.patch.object(API, 'session', self.session), mock.patch.object(API, 'cache', HTTPCache(self.tmp.name)):
+            results = EEB().get_many(dois, max_workers=3)
+            # in the order of the DOIs, with the exception of the DOI without referee reports
+            self.assertEqual(results[:-1], [self.reports[doi] for doi in dois[:-1]])
+            self.assertIsInstance(results[-1], ValueError)
+            # served from the response cache afterwards
+            self.session.sent.clear()
+            self.assertEqual(EEB().get_many(dois[:-1], max_workers=3), results[:-1])
+            self.assertEqual(self.session.sent, [])
+            # but not the response without referee reports
+            self.assertIsInstance(EEB().get_many(dois[-1:])[0], ValueError)
+            self.assertEqual(len(self.session.sent), 1)
+
+    def test_errors_not_cached(self):
+        cache = HTTPCache(self.tmp.name)
+        url = 'https://eeb.embo.org/api/v1/doi/10.1101/2020.01.01.000000'
+        session = mock.Mock()
+        session.get.side_effect = [response(url, 503, {}), response(url, 200, {'ok': True})]
+        with self.assertRaises(requests.HTTPError):
+            cache.get(session, url)
+        self.assertEqual(list(Path(self.tmp.name).glob('*/*.body')), [])
+        # the next request is sent to the server again
+        self.assertEqual(json.loads(cache.get(session, url)), {'ok': True})
+        self.assertEqual(session.get.call_count, 2)
+
+    def test_pooled_session(self):
+        session = pooled_session(16)
+        self.assertEqual(session.get_adapter('https://eeb.embo.org')._pool_maxsize, 16)
+        session.close()
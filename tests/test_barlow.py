@@ -1,7 +1,13 @@
 import unittest
+from pathlib import Path
+from shutil import rmtree
 import torch
 
-from src.models.barlow_embeddings import LatentEmbedding, LatentSentenceEmbedding, LatentParagraphEmbedding
+from src.models.barlow_embeddings import (
+    LatentEmbedding, LatentSentenceEmbedding, LatentParagraphEmbedding,
+    export_encoders, embedding_drift, PRETRAINED_BARLOW,
+)
+from src.models.barlow_twin import LatentEncoder, LATENT_ENCODER_WEIGHTS
 
 # Test case for testing the barlow twin latent embedding model
 
@@ -45,3 +51,56 @@ class TestLatentEmbedding(unittest.TestCase):
 
         paragraph_embedding = model(self.paragraph)
         self.assertIsInstance(paragraph_embedding, torch.Tensor)
+
+    def test_micro_batches(self):
+        # micro-batching and reordering by length must not change the embeddings
+        model = LatentParagraphEmbedding(batch_size=1)
+        inputs = self.paragraph + self.sentence + ["Short.", self.paragraph[0] * 3]
+        embeddings = model(inputs)
+        model.batch_size = len(inputs)
+        self.assertTrue(torch.allclose(embeddings, model(inputs), atol=1e-5))
+        for i, text in enumerate(inputs):
+            self.assertTrue(torch.allclose(embeddings[i], model([text])[0], atol=1e-5))
+
+    def test_represent(self):
+        # the inference path gives the representation of the full forward pass
+        model = LatentParagraphEmbedding()
+        tokenized = model.tokenizer(self.paragraph + self.sentence, return_tensors="pt", padding="max_length", max_length=model.seq_len, truncation=True)
+        with torch.no_grad():
+            expected = model.encoder(**tokenized).representation
+        representation = model.encoder.represent(**tokenized)
+        self.assertFalse(representation.requires_grad)
+        self.assertTrue(torch.allclose(representation, expected, atol=1e-5))
+
+    def test_export_encoders(self):
+        export_dir = Path("/tmp/test_barlow_encoders")
+        export_encoders(PRETRAINED_BARLOW, export_dir)
+        for mode, model in [('sentence', LatentSentenceEmbedding()), ('paragraph', LatentParagraphEmbedding())]:
+            self.assertTrue((export_dir / mode / LATENT_ENCODER_WEIGHTS).exists())
+            standalone = LatentEmbedding(str(export_dir), mode)
+            self.assertTrue(torch.allclose(standalone(self.paragraph), model(self.paragraph), atol=1e-5))
+        rmtree(export_dir)
+
+    def test_encoder_from_checkpoint(self):
+        # the loaded encoder holds only the pretrained encoder and the latent head, not the unused inherited modules
+        export_dir = Path("/tmp/test_barlow_checkpoint")
+        export_encoders(PRETRAINED_BARLOW, export_dir)
+        model = LatentParagraphEmbedding()
+        full_encoder = model.encoder
+        encoder = LatentEncoder.from_checkpoint(export_dir / 'paragraph')
+        self.assertFalse(any(p.is_meta for p in encoder.parameters()))
+        self.assertLess(sum(p.numel() for p in encoder.parameters()), sum(p.numel() for p in full_encoder.parameters()))
+        tokenized = model.tokenizer(self.paragraph, return_tensors="pt", padding="max_length", max_length=encoder.seq_length, truncation=True)
+        self.assertTrue(torch.allclose(encoder.represent(**tokenized), full_encoder.represent(**tokenized), atol=1e-5))
+        rmtree(export_dir)
+
+    def test_quantized_backends(self):
+        export_dir = Path("/tmp/test_barlow_onnx")
+        export_encoders(PRETRAINED_BARLOW, export_dir, onnx=True)
+        inputs = self.sentence + self.paragraph
+        reference = LatentEmbedding(str(export_dir), 'paragraph', backend='fp32')
+        for backend, tolerance in [('onnx', 1e-4), ('int8', 0.05)]:
+            candidate = LatentEmbedding(str(export_dir), 'paragraph', backend=backend)
+            drift = embedding_drift(reference, candidate, inputs)
+            self.assertLess(drift["max"], tolerance)
+        rmtree(export_dir)
@@ -0,0 +1,74 @@
+import unittest
+from pathlib import Path
+from functools import partial
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from src.chunk_index import ChunkIndex, chunking_id
+from src.utils import split_paragraphs
+
+"""Test cases for the persistent index of chunks"""
+
+class TestChunkIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.index = ChunkIndex(str(Path(self.tmp.name) / 'chunks.sqlite'))
+        self.texts = [
+            "The first paragraph of the introduction.\n  The second paragraph of the introduction.",
+            "A single paragraph of results.\r\nAnd another one after a windows line break.",
+        ]
+        self.keys = [('10.1101/2020.01.01.000001', 'introduction'), ('10.1101/2020.01.01.000001', 'results')]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_get_chunks(self):
+        expected = [split_paragraphs(text) for text in self.texts]
+        self.assertEqual(self.index.get_chunks(split_paragraphs, self.keys, self.texts), expected)
+        # served from the index, without chunking again
+        with mock.patch('src.chunk_index.chunk_texts') as chunk_texts:
+            self.assertEqual(self.index.get_chunks(split_paragraphs, self.keys, self.texts), expected)
+            chunk_texts.assert_not_called()
+        # a text that changed is chunked again
+        changed = [self.texts[0], self.texts[1] + "\nA paragraph added by a new version."]
+        self.assertEqual(self.index.get_chunks(split_paragraphs, self.keys, changed), [split_paragraphs(text) for text in changed])
+
+    def test_chunks_not_in_text(self):
+        upper = lambda text: [p.upper() for p in split_paragraphs(text)]
+        for _ in range(2):
+            self.assertEqual(self.index.get_chunks(upper, self.keys, self.texts), [upper(text) for text in self.texts])
+
+    def test_new_directory(self):
+        # the directories of the index are created on first use
+        index = ChunkIndex(str(Path(self.tmp.name) / 'not' / 'yet' / 'chunks.sqlite'))
+        expected = [split_paragraphs(text) for text in self.texts]
+        self.assertEqual(index.get_chunks(split_paragraphs, self.keys, self.texts), expected)
+        self.assertEqual(index.get_chunks(split_paragraphs, self.keys, self.texts), expected)
+
+    def test_chunking_id(self):
+        # chunkers made with different parameters do not share their chunks
+        def make(size):
+            return lambda text: [text[i:i + size] for i in range(0, len(text), size)]
+        self.assertEqual(chunking_id(make(5)), chunking_id(make(5)))
+        self.assertNotEqual(chunking_id(make(5)), chunking_id(make(12)))
+        for size in [5, 12]:
+            self.assertEqual(self.index.get_chunks(make(size), self.keys, self.texts), [make(size)(text) for text in self.texts])
+        first_line = lambda text, n: text.splitlines()[:n]
+        self.assertNotEqual(chunking_id(partial(first_line, n=1)), chunking_id(partial(first_line, n=2)))
+        self.assertEqual(self.index.get_chunks(partial(first_line, n=1), self.keys, self.texts), [first_line(text, 1) for text in self.texts])
+        # parameters without a stable description are not indexed
+        opaque = partial(first_line, n=object())
+        self.assertIsNone(chunking_id(opaque))
+
+    def test_no_doi(self):
+        # texts without a DOI are chunked but never stored
+        keys = [(None, 'review')]
+        for _ in range(3):
+            self.assertEqual(self.index.get_chunks(split_paragraphs, keys, self.texts[:1]), [split_paragraphs(self.texts[0])])
+        with self.index._file.transaction() as conn:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM chunks').fetchone()[0], 0)
+
+    def test_disabled(self):
+        index = ChunkIndex(None)
+        self.assertEqual(index.get_chunks(split_paragraphs, self.keys, self.texts), [split_paragraphs(text) for text in self.texts])
@@ -1,6 +1,7 @@
 import unittest
 from pathlib import Path
 from shutil import rmtree
+import torch
 
 from src.comparator import Comparator
 from src.preprint import Preprint
@@ -58,3 +59,55 @@ class TestComparator(unittest.TestCase):
         comp = Comparator([barlow_sentence_embedder, barlow_paragraph_embedder])
         similarity_matrix_dot = comp.compare_dot(review_sentences, preprint_paragraphs)
         self.assertEqual(tuple(similarity_matrix_dot.size()), (len(review_sentences), len(preprint_paragraphs)))
+
+    def test_block_dot(self):
+        preprint_paragraphs = self.preprint.get_chunks(split_paragraphs, config.sections)
+        review_chunks = [review.get_chunks(split_paragraphs) for review in self.review_process.reviews]
+        paras_1 = [preprint_paragraphs] * len(review_chunks) + [[]]
+        paras_2 = review_chunks + [review_chunks[0]]
+        comp = Comparator(self.embedders[0])
+        scores, offsets = comp.compare_dot_blocks(paras_1, paras_2)
+        self.assertEqual(offsets.numel(), len(paras_1) + 1)
+        self.assertEqual(scores.numel(), int(offsets[-1]))
+        for i, (para_1, para_2) in enumerate(zip(paras_1[:-1], paras_2[:-1])):
+            expected = comp.compare_dot(para_1, para_2).view(-1)
+            self.assertTrue(torch.allclose(scores[offsets[i]:offsets[i + 1]], expected, atol=1e-4))
+        self.assertEqual(int(offsets[-1] - offsets[-2]), 0)  # no paragraph, no score
+
+    def test_block_dot_shapes(self):
+        # pairs of very different shapes, and of the same size n x m, are not padded together
+        shapes = [(2, 500), (1000, 1), (3, 7), (0, 4), (8, 8), (5, 9), (500, 2)]
+        blocks_1 = [torch.randn(n, 16) for n, _ in shapes]
+        blocks_2 = [torch.randn(m, 16) for _, m in shapes]
+        scores, offsets = Comparator.block_dot(blocks_1, blocks_2, pairs_per_batch=2)
+        for i, (A, B) in enumerate(zip(blocks_1, blocks_2)):
+            self.assertTrue(torch.allclose(scores[offsets[i]:offsets[i + 1]], torch.mm(A, B.T).view(-1), atol=1e-4))
+
+    def test_compare_topk(self):
+        review_paragraphs = self.review_process.reviews[0].get_chunks(split_paragraphs)
+        preprint_paragraphs = self.preprint.get_chunks(split_paragraphs, config.sections)
+        comp = Comparator(self.embedders[0])
+        dense = comp.compare_dot(review_paragraphs, preprint_paragraphs)
+        k = 3
+        sparse = comp.compare_topk(review_paragraphs, preprint_paragraphs, k=k)
+        self.assertTrue(sparse.is_sparse)
+        self.assertEqual(tuple(sparse.size()), tuple(dense.size()))
+        # the k highest similarities of each row, as in the dense matrix
+        top_values = sparse.to_dense().topk(k, dim=1).values
+        self.assertTrue(torch.allclose(top_values, dense.topk(k, dim=1).values, atol=1e-5))
+        self.assertEqual(sparse._nnz(), k * len(review_paragraphs))
+        # tiles smaller than the matrix give the same result
+        tiled = Comparator.topk_dot(*comp.get_embeddings(review_paragraphs, preprint_paragraphs), k=k, block_size=2)
+        self.assertTrue(torch.allclose(tiled.to_dense(), sparse.to_dense(), atol=1e-5))
+        # with a threshold, only the similarities above it
+        threshold = float(dense.median())
+        above = comp.compare_topk(review_paragraphs, preprint_paragraphs, threshold=threshold)
+        self.assertEqual(above._nnz(), int((dense >= threshold).sum()))
+        tiled = Comparator.topk_dot(*comp.get_embeddings(review_paragraphs, preprint_paragraphs), threshold=threshold, block_size=2)
+        self.assertTrue(torch.allclose(tiled.to_dense(), above.to_dense(), atol=1e-5))
+        # both k and threshold, on the dense matrix itself: its product with the identity
+        both = Comparator.topk_dot(dense, torch.eye(dense.size(1)), k=k, threshold=threshold, block_size=2)
+        expected = sparse.to_dense() * (sparse.to_dense() >= threshold)
+        self.assertTrue(torch.allclose(both.to_dense(), expected, atol=1e-5))
+        with self.assertRaises(ValueError):
+            comp.compare_topk(review_paragraphs, preprint_paragraphs)
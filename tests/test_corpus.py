@@ -1,8 +1,14 @@
 import unittest
 from pathlib import Path
 from shutil import rmtree
+from tempfile import TemporaryDirectory
+from typing import List, Tuple
+from unittest import mock
 
-from src.corpus import Corpus
+from src.corpus import Corpus, IngestionManifest
+from src.preprint import Preprint, BioRxivMetadata
+from src.review_process import ReviewProcess, Review
+from src.reviewed_preprint import ReviewedPreprint
 from src.utils import stringify_doi
 
 # Test case for testing the methods of the ReviewedPreprin class
@@ -42,4 +48,148 @@ class TestCorpus(unittest.TestCase):
 
         restored_corpus = Corpus().from_dir(self.basedir)
         self.assertEqual(set(self.corpus.doi_list), set(restored_corpus.doi_list))
-        self.assertEqual(len(self.corpus), len(restored_corpus))
\ No newline at end of file
+        self.assertEqual(len(self.corpus), len(restored_corpus))
+
+    def test_ingest(self):
+        ingest_dir = self.basedir / 'ingest'
+        missing_doi = '10.1101/0000.00.00.000000'
+        corpus = Corpus().ingest(self.doi_list + [missing_doi], ingest_dir, max_workers=2)
+        self.assertEqual(set(corpus.doi_list), set(self.doi_list))
+        manifest = IngestionManifest(ingest_dir)
+        self.assertEqual(set(manifest.completed), set(self.doi_list))
+        self.assertEqual(manifest.failed, [missing_doi])
+        self.assertFalse((ingest_dir / stringify_doi(missing_doi)).exists())
+        # resuming skips everything already processed
+        self.assertEqual(manifest.pending(self.doi_list + [missing_doi]), [])
+        self.assertEqual(manifest.pending(self.doi_list + [missing_doi], retry_failed=True), [missing_doi])
+        # a later run only returns the DOIs it was given
+        corpus = Corpus().ingest(self.doi_list[:1], ingest_dir)
+        self.assertEqual(corpus.doi_list, self.doi_list[:1])
+
+    def test_save_columnar(self):
+        store_path = self.basedir / 'corpus.sqlite'
+        self.corpus.save_columnar(store_path)
+        restored_corpus = Corpus().load_columnar(store_path)
+        self.assertEqual(set(self.corpus.doi_list), set(restored_corpus.doi_list))
+        for reviewed_preprint in restored_corpus.reviewed_preprints:
+            original = next(rp for rp in self.corpus.reviewed_preprints if rp.doi == reviewed_preprint.doi)
+            self.assertEqual(original.preprint.sections, reviewed_preprint.preprint.sections)
+            self.assertEqual(original.preprint.biorxiv_meta, reviewed_preprint.preprint.biorxiv_meta)
+            self.assertEqual(
+                sorted(r.asdict()['review_idx'] for r in original.review_process.reviews),
+                sorted(r.asdict()['review_idx'] for r in reviewed_preprint.review_process.reviews)
+            )
+        # saving again replaces the previous version instead of duplicating rows
+        self.corpus.save_columnar(store_path)
+        self.assertEqual(len(Corpus().load_columnar(store_path)), len(self.corpus))
+
+    def test_lazy(self):
+        store_path = self.basedir / 'lazy_corpus.sqlite'
+        self.corpus.save_columnar(store_path)
+        self.corpus.save(self.basedir / 'lazy')
+        for lazy_corpus in [Corpus().load_columnar(store_path, lazy=True), Corpus().from_dir(self.basedir / 'lazy', lazy=True)]:
+            self.assertEqual(len(lazy_corpus), len(self.corpus))
+            self.assertEqual(set(lazy_corpus.doi_list), set(self.doi_list))
+            for i, doi in enumerate(lazy_corpus.doi_list):
+                reviewed_preprint = lazy_corpus.reviewed_preprints[i]
+                self.assertEqual(reviewed_preprint.doi, doi)
+                # materialized once and then served from the cache
+                self.assertIs(lazy_corpus.reviewed_preprints[i], reviewed_preprint)
+
+    def test_sync_state(self):
+        sync_dir = self.basedir / 'sync'
+        self.corpus.save(sync_dir)
+        local_state = Corpus._local_state(sync_dir)
+        self.assertEqual(set(local_state), set(self.doi_list))
+        for reviewed_preprint in self.corpus.reviewed_preprints:
+            reviews = [review.asdict() for review in reviewed_preprint.review_process.reviews]
+            posting_date, version = local_state[reviewed_preprint.doi]
+            self.assertEqual(posting_date, max(review['posting_date'] for review in reviews))
+            self.assertGreaterEqual(version, 1)
+
+
+class TestSync(unittest.TestCase):
+    """Sync against a stubbed feed of the Early Evidence Base, without network."""
+
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.directory = Path(self.tmp.name)
+        self.unchanged = '10.1101/2020.01.01.000001'
+        self.updated = '10.1101/2020.01.01.000002'
+        self.new = '10.1101/2020.01.01.000003'
+        # the reviews of each DOI in the feed, as (posting date, version of the preprint reviewed)
+        self.feed = {
+            self.unchanged: [('2021-01-01', 1)],
+            self.updated: [('2021-01-01', 1)],
+            self.new: [('2021-03-01', 1)],
+        }
+        self.fetched = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def reviewed_preprint(self, doi: str, reviews: List[Tuple[str, int]]) -> ReviewedPreprint:
+        preprint = Preprint()
+        preprint.doi = doi
+        preprint.biorxiv_meta = BioRxivMetadata(doi=doi)
+        preprint.sections = {'introduction': 'An introduction.'}
+        review_process = ReviewProcess()
+        review_process.doi = doi
+        review_process.reviews = [
+            Review(review_idx=str(i), posting_date=posting_date, related_article_doi=doi, related_article_uri=f'https://www.biorxiv.org/content/{doi}v{version}')
+            for i, (posting_date, version) in enumerate(reviews)
+        ]
+        reviewed_preprint = ReviewedPreprint()
+        reviewed_preprint.from_objects(preprint, review_process)
+        return reviewed_preprint
+
+    def fetch(self, doi=None, streaming=False):
+        if doi is None:
+            return ReviewedPreprint()
+        self.fetched.append(doi)
+        return self.reviewed_preprint(doi, self.feed[doi])
+
+    def feed_records(self, per_page=100):
+        for doi, reviews in self.feed.items():
+            yield {'doi': doi, 'review_process': {'reviews': [
+                {'posting_date': posting_date, 'related_article_uri': f'https://www.biorxiv.org/content/{doi}v{version}'}
+                for posting_date, version in reviews
+            ]}}
+
+    def test_sync(self):
+        # saved outside of ingest() or sync(), so not in the manifest
+        self.reviewed_preprint(self.unchanged, self.feed[self.unchanged]).save(self.directory)
+        self.reviewed_preprint(self.updated, self.feed[self.updated]).save(self.directory)
+        self.feed[self.updated] = self.feed[self.updated] + [('2021-02-01', 2)]
+        with mock.patch.object(Corpus, '_feed', side_effect=self.feed_records), \
+                mock.patch('src.corpus.ReviewedPreprint', side_effect=self.fetch), \
+                mock.patch('src.corpus.EEB') as eeb, mock.patch('src.corpus.BioRxiv') as biorxiv:
+            for api in [eeb, biorxiv]:
+                api.return_value.get_many.side_effect = lambda dois, *args: [{} for _ in dois]
+            corpus = Corpus().sync(self.directory, max_workers=2)
+            # only the new and the updated DOIs are fetched
+            self.assertEqual(sorted(self.fetched), [self.updated, self.new])
+            self.assertEqual(set(corpus.doi_list), {self.unchanged, self.updated, self.new})
+            reviews = {rp.doi: len(rp.review_process.reviews) for rp in corpus.reviewed_preprints}
+            self.assertEqual(reviews[self.updated], 2)
+            self.assertEqual(set(IngestionManifest(self.directory).completed), {self.updated, self.new})
+            # the API responses of the DOIs fetched are revalidated in bulk
+            self.assertEqual(sorted(eeb.return_value.get_many.call_args.args[0]), [self.updated, self.new])
+            self.assertTrue(eeb.return_value.get_many.call_args.args[2])
+            # nothing left to fetch
+            self.fetched.clear()
+            corpus = Corpus().sync(self.directory)
+            self.assertEqual(self.fetched, [])
+            self.assertEqual(len(corpus), 3)
+
+
+class TestColumnar(unittest.TestCase):
+
+    def test_missing_store(self):
+        # reading a store that does not exist fails instead of returning an empty corpus
+        with TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'mistyped' / 'corpus.sqlite'
+            for lazy in [False, True]:
+                with self.assertRaises(FileNotFoundError):
+                    Corpus().load_columnar(path, lazy=lazy)
+            self.assertFalse(path.parent.exists())
@@ -0,0 +1,32 @@
+import unittest
+import numpy as np
+
+from src.distribution import SimilarityDistribution
+
+
+class TestSimilarityDistribution(unittest.TestCase):
+
+    def test_update_and_merge(self):
+        rng = np.random.default_rng(0)
+        scores = np.tanh(rng.normal(size=100_000))
+        whole = SimilarityDistribution()
+        whole.update(scores)
+        left, right = SimilarityDistribution(), SimilarityDistribution()
+        left.update(scores[:40_000])
+        right.update(scores[40_000:])
+        left.merge(right)
+        self.assertTrue(np.array_equal(left.counts, whole.counts))
+        self.assertEqual(left.n, scores.size)
+        self.assertAlmostEqual(left.mean, scores.mean(), places=6)
+        self.assertAlmostEqual(left.std, scores.std(), places=6)
+
+    def test_quantile_and_cdf(self):
+        rng = np.random.default_rng(1)
+        scores = rng.uniform(-0.5, 0.9, size=100_000)
+        distribution = SimilarityDistribution()
+        distribution.update(scores)
+        for q in (0.01, 0.5, 0.99):
+            self.assertAlmostEqual(distribution.quantile(q), np.quantile(scores, q), delta=1e-3)
+            self.assertAlmostEqual(distribution.cdf(np.quantile(scores, q)), q, delta=1e-3)
+        self.assertEqual(distribution.cdf(-1.0), 0.0)
+        self.assertEqual(distribution.cdf(1.0), 1.0)
@@ -1,10 +1,12 @@
 import unittest
+from pathlib import Path
+from shutil import rmtree
 import torch
 import openai
 
 from src.embed import (
     OpenAIEmbedder, SBERTEmbedder,
-    BarlowEmbedder,
+    BarlowEmbedder, EmbeddingCache,
 )
 from src.config import config
 
@@ -44,3 +46,39 @@ class TestEmbedder(unittest.TestCase):
         embeddings = barlow_embedder.get_embedding(self.samples)
         self.assertIsInstance(embeddings, torch.Tensor)
         self.assertEqual(list(embeddings.size()), [len(self.samples), 512])
+
+    def test_embedding_cache(self):
+        cache_dir = Path("/tmp/test_embedding_cache")
+        rmtree(cache_dir, ignore_errors=True)
+        # the directory of the cache does not exist yet; vectors are stored with the default float16 precision
+        embedder = SBERTEmbedder(cache=EmbeddingCache(str(cache_dir / "cache" / "embeddings.sqlite")))
+        expected = embedder._embed(self.samples).cpu()
+        # the first call fills the cache with the unique inputs, the second is served from it
+        inputs = self.samples + self.samples[:2]
+        first = embedder.get_embedding(inputs)
+        self.assertEqual(list(first.size()), [len(inputs), 768])
+        self.assertTrue(torch.allclose(first[:len(self.samples)], expected, atol=1e-3))
+        self.assertTrue(torch.equal(first[len(self.samples):], first[:2]))
+        # computed or cached, the embeddings are the same
+        self.assertTrue(torch.equal(embedder.get_embedding(inputs), first))
+        self.assertEqual(embedder.cache.get(embedder.cache_id, ["not cached"]), [None])
+        rmtree(cache_dir)
+
+    def test_openai_batches(self):
+        embedder = OpenAIEmbedder(model="text-embedding-ada-002", cache=None, max_tokens=300, max_items=2, max_workers=2)
+        batches = embedder._batches(self.samples)
+        self.assertEqual([text for batch, _ in batches for text in batch], self.samples)
+        self.assertTrue(all(len(batch) <= 2 for batch, _ in batches))
+        embeddings = embedder.get_embedding(self.samples)
+        self.assertEqual(list(embeddings.size()), [len(self.samples), 1536])
+        self.assertTrue(torch.allclose(embeddings, self.openai_embedder._embed(self.samples), atol=1e-3))
+
+    def test_sbert_pool(self):
+        embedder = SBERTEmbedder(cache=None)
+        inputs = self.samples * 10
+        expected = embedder.get_embedding(inputs).cpu()
+        with embedder.pool(processes=2, threads_per_process=1, chunk_size=8) as pooled:
+            embeddings = pooled.get_embedding(inputs)
+        self.assertEqual(list(embeddings.size()), [len(inputs), 768])
+        self.assertTrue(torch.allclose(embeddings, expected, atol=1e-4))
+        self.assertIsNone(embedder._pool)
@@ -0,0 +1,78 @@
+import unittest
+import subprocess
+import sys
+import json
+import os
+import time
+from typing import List, Tuple
+
+"""Test cases to check that the public modules import quickly and without loading models or NLP pipelines"""
+
+# the libraries that must only be imported on first use
+HEAVY = ['spacy', 'nltk', 'openai', 'tiktoken', 'sentence_transformers', 'transformers', 'dotenv']
+
+# maximum import time in seconds of each public module, over the startup of a bare interpreter
+IMPORT_BUDGETS = {
+    'src': 0.5,
+    'src.config': 0.5,
+    'src.utils': 1.0,
+    'src.distribution': 1.0,
+    'src.chunk_index': 1.0,
+    'src.api_tools': 1.0,
+    'src.preprint': 1.0,
+    'src.corpus': 1.0,
+}
+
+# the modules that work on embeddings import torch, which dominates their import time and varies widely between
+# machines; their generous budgets are only checked as a slow test, with RUN_SLOW=1
+TORCH_IMPORT_BUDGETS = {
+    'src.embed': 10.0,
+    'src.comparator': 10.0,
+    'src.corpus_embeddings': 10.0,
+    'src.sampler': 10.0,
+}
+
+SCRIPT = """
+import json, sys
+import {module}
+print(json.dumps({{"modules": list(sys.modules)}}))
+"""
+
+
+def run(code: str) -> Tuple[float, str]:
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+    return time.perf_counter() - start, result.stdout
+
+
+def loaded_modules(module: str) -> List[str]:
+    _, stdout = run(SCRIPT.format(module=module))
+    return json.loads(stdout.strip().splitlines()[-1])['modules']
+
+
+def import_seconds(module: str, repeat: int = 3) -> float:
+    """The wall-clock time to import a module in a fresh interpreter, minus that of starting a bare interpreter, at best of repeat runs."""
+    baseline = min(run('pass')[0] for _ in range(repeat))
+    return min(run(f'import {module}')[0] for _ in range(repeat)) - baseline
+
+
+class TestImports(unittest.TestCase):
+
+    def test_heavy_modules(self):
+        for module in {**IMPORT_BUDGETS, **TORCH_IMPORT_BUDGETS}:
+            with self.subTest(module=module):
+                loaded = [heavy for heavy in HEAVY if heavy in loaded_modules(module)]
+                self.assertEqual(loaded, [])
+
+    def test_import_budgets(self):
+        for module, budget in IMPORT_BUDGETS.items():
+            with self.subTest(module=module):
+                self.assertLess(import_seconds(module), budget)
+
+    @unittest.skipUnless(os.environ.get('RUN_SLOW'), "slow test, set RUN_SLOW=1 to run it")
+    def test_torch_import_budgets(self):
+        for module, budget in TORCH_IMPORT_BUDGETS.items():
+            with self.subTest(module=module):
+                seconds = import_seconds(module)
+                print(f"import {module}: {seconds:.3f}s")
+                self.assertLess(seconds, budget)
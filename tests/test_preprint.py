@@ -2,7 +2,10 @@ import unittest
 from shutil import rmtree
 from pathlib import Path
 
-from src.preprint import Preprint
+from io import BytesIO, StringIO
+from lxml.etree import fromstring, tostring, parse
+
+from src.preprint import Preprint, JATSSectionExtractor, StreamingJATSSectionExtractor, JATS_PARSER, JATS_DTD, jats_doctype
 from src.utils import stringify_doi
 
 # Test case for testing the methods of the Preprint class
@@ -118,3 +121,55 @@ class TestPreprint(unittest.TestCase):
     def test_biorxiv_meta(self):
         meta = self.preprint.biorxiv_meta  # this is a dataclass
         self.assertEqual(meta.asdict(), self.meta)  # type: ignore[reportOptionalMemberAccess]
+
+
+class TestJATSSectionExtractor(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.xml = fromstring("""<article><body>
+            <sec><title>Introduction</title><p>Intro 1.</p><p>Intro 2.</p></sec>
+            <sec><title>Results and Discussion</title>
+                <sec><title>First result</title><p>Result 1 <fig><caption><title>Figure 1.</title><p>Legend
+1.</p></caption></fig>is shown.</p> see text.</sec>
+                <sec><title>Second result</title><p>Result 2.</p></sec>
+            </sec>
+            <sec><title>Discussion</title><p>Discussion.</p></sec>
+            <sec><title>Materials and Methods</title><sec><title>Cells</title><p>Method 1.</p></sec></sec>
+        </body></article>""")
+        cls.expected = {
+            "introduction": "Intro 1.\n\nIntro 2.",
+            "results": "Result 1 \n\nResult 2.",  # the figure is removed together with its tail
+            "result_headings": "First result\n\nSecond result",
+            "figures": "Figure 1.Legend 1.",
+            "fig_titles": "Figure 1.",
+            "methods": "Method 1.",
+            "discussion": "Discussion.",
+        }
+
+    def test_extract(self):
+        sections = JATSSectionExtractor().extract(self.xml)
+        self.assertEqual(sections, self.expected)
+
+    def test_streaming_extract(self):
+        sections = StreamingJATSSectionExtractor().extract(BytesIO(tostring(self.xml)))
+        self.assertEqual(sections, self.expected)
+        # named entities are dropped without a DTD, as by the tree parser
+        xml_bytes = b"<article><body><sec><title>Introduction</title><p>An &alpha; helix&nbsp;here.</p></sec></body></article>"
+        streamed = StreamingJATSSectionExtractor(dtd_dir="").extract(BytesIO(xml_bytes))
+        parsed = JATSSectionExtractor().extract(parse(BytesIO(xml_bytes), JATS_PARSER).getroot())
+        self.assertEqual(streamed["introduction"], "An  helixhere.")
+        self.assertEqual(streamed, parsed)
+
+    def test_jats_doctype(self):
+        dtd_dir = Path("/tmp/test_jats_dtd")
+        dtd_dir.mkdir(parents=True, exist_ok=True)
+        (dtd_dir / 'chars.ent').write_text('<!ENTITY nbsp "&#160;"><!ENTITY mdash "&#x2014;"><!ENTITY dash "&mdash;">')
+        (dtd_dir / JATS_DTD).write_text('<!ENTITY % chars.ent SYSTEM "chars.ent">%chars.ent;<!ELEMENT article ANY>')
+        xml_string = "<article><p>a&nbsp;b&dash;c</p></article>"
+        doctype = jats_doctype(xml_string, str(dtd_dir))
+        self.assertIn("nbsp", doctype)
+        self.assertIn("mdash", doctype)  # referenced by dash
+        xml = parse(StringIO(doctype + xml_string), JATS_PARSER).getroot()
+        self.assertEqual(xml.find('p').text, "a\u00a0b\u2014c")
+        rmtree(dtd_dir)
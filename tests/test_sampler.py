@@ -41,3 +41,41 @@ class TestSample(unittest.TestCase):
         self.assertGreater(len(distros['enriched']), 0)
         self.assertEqual(torch.Tensor(distros['null']).dim(), 1)
         self.assertEqual(torch.Tensor(distros['enriched']).dim(), 1)
+
+    def test_corpus_embeddings(self):
+        embedder = SBERTEmbedder()
+        sampler = Sampler(self.corpus, embedder=embedder, chunking_fn=[split_sentences, split_paragraphs])
+        embeddings = sampler.corpus_embeddings
+        self.assertEqual(embeddings.dois, self.corpus.doi_list)
+        for rev_preprint in self.corpus.reviewed_preprints:
+            # slicing the corpus matrix gives the embeddings of the chunks of each preprint and review
+            preprint_chunks = rev_preprint.preprint.get_chunks(split_paragraphs, embeddings.sections)
+            self.assertTrue(torch.allclose(embeddings.preprint(rev_preprint.doi), embedder.get_embedding(preprint_chunks).cpu(), atol=1e-3))
+            reviews = embeddings.reviews(rev_preprint.doi)
+            self.assertEqual(len(reviews), len(rev_preprint.review_process.reviews))
+            for review, review_embeddings in zip(rev_preprint.review_process.reviews, reviews):
+                self.assertEqual(review_embeddings.size(0), len(review.get_chunks(split_sentences)))
+
+    def test_accumulate(self):
+        sampler = Sampler(self.corpus, embedder=SBERTEmbedder(), chunking_fn=split_paragraphs)
+        distros = sampler.accumulate(n_sample=2, pairs_per_batch=1)
+        self.assertGreater(distros['null'].n, 0)
+        self.assertGreater(distros['enriched'].n, 0)
+        # a second run adds to the same accumulators
+        n_null = distros['null'].n
+        distros = sampler.accumulate(n_sample=2, distributions=distros)
+        self.assertGreater(distros['null'].n, n_null)
+        self.assertLessEqual(distros['enriched'].quantile(0.5), distros['enriched'].max)
+
+    def test_sample_parallel(self):
+        sampler = Sampler(self.corpus, embedder=SBERTEmbedder(), chunking_fn=split_paragraphs)
+        replicates = sampler.sample_parallel(n_sample=2, seed=1, replicates=2, n_shards=2, processes=2)
+        self.assertEqual(len(replicates), 2)
+        # the same seed gives the same distributions whatever the number of processes
+        again = sampler.sample_parallel(n_sample=2, seed=1, replicates=2, n_shards=2, processes=1)
+        for distros, distros_again in zip(replicates, again):
+            self.assertGreater(distros['null'].n, 0)
+            self.assertTrue((distros['null'].counts == distros_again['null'].counts).all())
+            self.assertTrue((distros['enriched'].counts == distros_again['enriched'].counts).all())
+        # and sample() with a seed is reproducible
+        self.assertTrue((sampler.sample(n_sample=2, seed=1)['null'] == sampler.sample(n_sample=2, seed=1)['null']).all())
@@ -1,6 +1,7 @@
 import unittest
 
-from src.utils import split_paragraphs, split_sentences, split_sentences_nltk, stringify_doi, filtering
+from src.utils import split_paragraphs, split_sentences, split_sentences_nltk, split_sentences_batch, chunk_texts, stringify_doi, filtering, filter_chunks, filter_corpus_chunks
+from src.config import config
 
 
 """Test cases to test the functions of the utils module"""
@@ -79,7 +80,17 @@ In addition, the selection of the markers leis suboptimal. Although PCNA is a go
         sentences = split_sentences_nltk(text)
         self.assertEqual(sentences, expected)
 
-    
+
+    def test_split_sentences_batch(self):
+        texts = [
+            "This is the first text. It has two sentences in it.",
+            "",
+            "The second text is a single sentence of reasonable length.",
+        ]
+        # the same sentences as splitting each text on its own, in the order of the texts
+        self.assertEqual(split_sentences_batch(texts, batch_size=2), [split_sentences(text) for text in texts])
+        self.assertEqual(chunk_texts(split_sentences, texts), [split_sentences(text) for text in texts])
+        self.assertEqual(chunk_texts(split_paragraphs, texts), [split_paragraphs(text) for text in texts])
 
     def test_filter(self):
         docs =[
@@ -89,3 +100,19 @@ In addition, the selection of the markers leis suboptimal. Although PCNA is a go
         ]
         filtered = filtering(docs)
         self.assertEqual(filtered[0], docs[1])
+
+    def test_filter_chunks(self):
+        chunks = [
+            "short",
+            "A chunk of text long enough to be kept.",
+            "### Referee \#1 is boilerplate",
+            "**Major comments:** are boilerplate too",
+            "A chunk that only becomes boilerplate from the config.",
+        ]
+        self.assertEqual(filter_chunks(chunks), [chunks[1], chunks[4]])
+        self.assertEqual(filter_corpus_chunks([chunks, chunks[:2]]), [[chunks[1], chunks[4]], [chunks[1]]])
+        config.extra_boilerplate.append("only becomes boilerplate")
+        try:
+            self.assertEqual(filter_chunks(chunks), [chunks[1]])
+        finally:
+            config.extra_boilerplate.remove("only becomes boilerplate")